@@ -0,0 +1,298 @@
+import argparse
+import json
+import random
+import sys
+import time
+from itertools import islice
+from typing import Callable, Dict, List
+
+import numpy
+
+from core.common import Queuer, MatchMaker
+from core.engine import Engine, OnLobbyFoundListener
+from core.environments import SimpleEnvironment, AdvancedEnvironment
+from core.matchmakers import simple_matchmaker, advanced_matchmaker, advanced_matchmaker2, fair_matchmaker, \
+    batch_matchmaker, incremental_matchmaker, find_lobby_for, BatchMatchmaker, CompositeMatchmaker, fair_method, TEAM_SIZE
+from core.mmr_engine import BaseMmrEngine, CheatingMmrEngine
+from core.sharding import ShardedMatchmaker, CROSS_SHARD
+from myMatchMaker import MyMatchMaker
+
+MATCHMAKERS = {
+    "simple": simple_matchmaker,
+    "advanced": advanced_matchmaker,
+    "advanced2": advanced_matchmaker2,
+    "fair": fair_matchmaker,
+    "batch": batch_matchmaker,
+    "incremental": incremental_matchmaker,
+    "sharded": ShardedMatchmaker(batch_matchmaker),
+    "my": MyMatchMaker(),
+}
+
+
+class BackloggedEnvironment(AdvancedEnvironment):
+    """
+    An AdvancedEnvironment that keeps about queue_size players queued: every round, the sleeping players
+    with the earliest wake rounds are woken early to top the queue up. Game lengths are divided by
+    GAME_TIME_SCALE, so that players are back soon and a population of a few times the queue size lasts.
+    """
+
+    GAME_TIME_SCALE = 300
+
+    def __init__(self, queue_size: int):
+        super().__init__(num_players=queue_size * 6, num_active_from_start=queue_size * 6)
+        self.queue_size = queue_size
+
+    def one_round(self):
+        super().one_round()
+        self.top_up_queue(self.queue_size)
+
+    def new_games(self, lobbies):
+        games = super().new_games(lobbies)
+        for game in games:
+            game.length = max(1, game.length // self.GAME_TIME_SCALE)
+        return games
+
+
+# builds an environment in which roughly `size` players are queueing (simple: only in the first rounds)
+ENVIRONMENTS = {
+    "simple": lambda size: SimpleEnvironment(num_players=size),
+    "advanced": lambda size: BackloggedEnvironment(size),
+}
+
+# reported, but neither better nor worse when it changes
+INFO_METRICS = {"avg_queue_length"}
+
+# searches of bench_sharding: sharding pays off when searching the queue costs more than sending its changes
+SHARDED_SEARCHES = {
+    "batch": BatchMatchmaker,
+    "fair": lambda: CompositeMatchmaker(fair_method),
+}
+for _search in SHARDED_SEARCHES:
+    for _variant in [_search, _search + "_sharded"]:
+        INFO_METRICS.update(_variant + "_" + metric for metric in ["cpu_ms_per_round", "avg_wait", "avg_spread"])
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+
+class LobbyCounter(OnLobbyFoundListener):
+    def __init__(self):
+        self.lobbies = 0
+
+    def on_lobby_found(self, team_1: List[Queuer], team_2: List[Queuer]) -> None:
+        self.lobbies += 1
+
+
+def bench_throughput(matchmaker_name: str, environment_name: str, size: int, budget: float) -> Dict[str, float]:
+    _seed()
+    engine = Engine(MATCHMAKERS[matchmaker_name], BaseMmrEngine(), ENVIRONMENTS[environment_name](size))
+    counter = LobbyCounter()
+    engine.add_on_lobby_found_listener(counter)
+    rounds = 0
+    queued = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget:
+        engine.one_round()
+        rounds += 1
+        queued += len(engine.queue())
+    elapsed = time.perf_counter() - start
+    # stops the workers of the sharded matchmaker; the next case starts them over on its own queue
+    engine.close()
+    return {"rounds_per_s": rounds / elapsed, "lobbies_per_s": counter.lobbies / elapsed,
+            "avg_queue_length": queued / rounds}
+
+
+class SearchMeter(MatchMaker, OnLobbyFoundListener):
+    """
+    Wraps a matchmaker to count the CPU time of this process spent in its searches, and the lobby quality.
+    The time the engine takes to start the found lobbies is left out: it is the same with any matchmaker.
+    """
+
+    def __init__(self, match_maker: MatchMaker):
+        self.match_maker = match_maker
+        self.cpu_seconds = 0.0
+        self.lobbies = 0
+        self.waited = 0
+        self.spread = 0
+
+    def find_lobbies(self, queue, found_lobby_callback) -> None:
+        def timed_callback(team_1, team_2):
+            start = time.process_time()
+            found_lobby_callback(team_1, team_2)
+            self.cpu_seconds -= time.process_time() - start
+
+        start = time.process_time()
+        self.match_maker.find_lobbies(queue, timed_callback)
+        self.cpu_seconds += time.process_time() - start
+
+    def next_search_in(self, queue):
+        return self.match_maker.next_search_in(queue)
+
+    def close(self) -> None:
+        self.match_maker.close()
+
+    def on_lobby_found(self, team_1: List[Queuer], team_2: List[Queuer]) -> None:
+        mmrs = [q.player.mmr for q in team_1 + team_2]
+        self.lobbies += 1
+        self.waited += sum(q.waited for q in team_1 + team_2) / len(mmrs)
+        self.spread += max(mmrs) - min(mmrs)
+
+
+def bench_sharding(size: int, budget: float) -> Dict[str, float]:
+    """
+    A cheap and a costly search with and without sharding, on the same seeded queue. The workers search in
+    other processes, so the search CPU time of this process is the coordinator's alone: with a core per
+    worker, rounds can't get faster than that, which bounds the speedup (max_speedup). On a single core,
+    the sharded rounds_per_s includes the workers' time.
+    """
+    results = dict()
+    for search_name, new_match_maker in SHARDED_SEARCHES.items():
+        for name, match_maker in [(search_name, new_match_maker()),
+                                  (search_name + "_sharded", ShardedMatchmaker(new_match_maker(), min_queue_size=0))]:
+            _seed()
+            environment = BackloggedEnvironment(size)
+            meter = SearchMeter(match_maker)
+            engine = Engine(meter, CheatingMmrEngine(environment), environment)
+            engine.add_on_lobby_found_listener(meter)
+            rounds = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < budget / 2 / len(SHARDED_SEARCHES):
+                engine.one_round()
+                rounds += 1
+            results[name + "_rounds_per_s"] = rounds / (time.perf_counter() - start)
+            results[name + "_cpu_ms_per_round"] = 1000 * meter.cpu_seconds / rounds
+            results[name + "_avg_wait"] = meter.waited / max(1, meter.lobbies)
+            results[name + "_avg_spread"] = meter.spread / max(1, meter.lobbies)
+            if isinstance(match_maker, ShardedMatchmaker):
+                cross_lobbies = match_maker.lobbies_per_shard[CROSS_SHARD]
+                results[search_name + "_worker_lobby_share"] = 1 - cross_lobbies / max(1, meter.lobbies)
+            engine.close()
+        results[search_name + "_max_speedup"] = results[search_name + "_cpu_ms_per_round"] / \
+            max(1e-3, results[search_name + "_sharded_cpu_ms_per_round"])
+    return results
+
+
+def bench_find_lobby_for(size: int, budget: float) -> Dict[str, float]:
+    engine = _engine_with_queue(size)
+    queue = engine.queue()
+    head = list(islice(queue, 100))
+    return {"calls_per_s": _calls_per_second(lambda: find_lobby_for(random.choice(head), queue), budget)}
+
+
+def bench_statistics(size: int, budget: float) -> Dict[str, float]:
+    _seed()
+    engine = Engine(fair_matchmaker, BaseMmrEngine(), SimpleEnvironment(num_players=size))
+    engine.run(200)
+    players = list(engine.players.values())
+    return {"calls_per_s": _calls_per_second(lambda: engine.statistics(players), budget)}
+
+
+def bench_progress_games(size: int, budget: float) -> Dict[str, float]:
+    # the whole population keeps playing: the simple environment queues the players of a game again when
+    # it ends, and they are put in the next games in the order they come back
+    engine = _engine_with_queue(size, CompositeMatchmaker(_first_in_line))
+    rounds = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget:
+        engine.one_round()
+        rounds += 1
+    return {"rounds_per_s": rounds / (time.perf_counter() - start)}
+
+
+def _first_in_line(queue) -> (List[Queuer], List[Queuer]):
+    if len(queue) < TEAM_SIZE * 2:
+        return None
+    picked = list(islice(queue, TEAM_SIZE * 2))
+    return picked[:TEAM_SIZE], picked[TEAM_SIZE:]
+
+
+MICRO_BENCHMARKS = {
+    "sharding": bench_sharding,
+    "find_lobby_for": bench_find_lobby_for,
+    "statistics": bench_statistics,
+    "progress_games": bench_progress_games,
+}
+
+
+def run_benchmarks(sizes: List[int], budget: float, name_filter: str = "") -> Dict[str, Dict[str, float]]:
+    results = dict()
+    for environment_name in ENVIRONMENTS:
+        for matchmaker_name in MATCHMAKERS:
+            for size in sizes:
+                name = "throughput/" + environment_name + "/" + matchmaker_name + "/" + str(size)
+                if name_filter in name:
+                    results[name] = _report(name, bench_throughput(matchmaker_name, environment_name, size, budget))
+    for micro_name, bench in MICRO_BENCHMARKS.items():
+        for size in sizes:
+            name = "micro/" + micro_name + "/" + str(size)
+            if name_filter in name:
+                results[name] = _report(name, bench(size, budget))
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> int:
+    """Print the change of every metric against the baseline; returns the number of regressions."""
+    regressions = 0
+    print("")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            if metric in INFO_METRICS or name not in baseline or metric not in baseline[name] or \
+                    baseline[name][metric] == 0:
+                continue
+            ratio = value / baseline[name][metric]
+            if ratio < 1 - tolerance:
+                verdict = "REGRESSION"
+                regressions += 1
+            elif ratio > 1 + tolerance:
+                verdict = "improvement"
+            else:
+                verdict = ""
+            print((name + " " + metric).ljust(60) + ("x%.2f" % ratio).rjust(10) + "  " + verdict)
+    return regressions
+
+
+def _engine_with_queue(size: int, match_maker: MatchMaker = fair_matchmaker) -> Engine:
+    _seed()
+    environment = SimpleEnvironment(num_players=size)
+    engine = Engine(match_maker, CheatingMmrEngine(environment), environment)
+    # the environment queues the whole population, with their skill as MMR, at the end of the first round
+    engine.one_round()
+    return engine
+
+
+def _calls_per_second(call: Callable, budget: float) -> float:
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget:
+        call()
+        calls += 1
+    return calls / (time.perf_counter() - start)
+
+
+def _report(name: str, metrics: Dict[str, float]) -> Dict[str, float]:
+    print(name.ljust(50) + "".join((k + "=" + ("%.1f" % v)).rjust(26) for k, v in metrics.items()))
+    return metrics
+
+
+def _seed():
+    random.seed(0)
+    numpy.random.seed(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Engine and matchmaker throughput benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--budget", type=float, default=2.0, help="seconds per benchmark")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="compare the results against a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    bench_results = run_benchmarks(args.sizes, args.budget, args.filter)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(bench_results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            num_regressions = compare(bench_results, json.load(f), args.tolerance)
+        sys.exit(1 if num_regressions > 0 else 0)
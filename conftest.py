@@ -0,0 +1 @@
+# puts the repository root on sys.path, so that tests import the core package however pytest is started
@@ -0,0 +1,246 @@
+"""
+Command line entry point: python -m core <simulate|compare|sweep|demo|export|record> [options], run from the
+repository root (core is imported from the working directory; it isn't installed as a package).
+
+Only argparse is imported up front; every subcommand imports what it needs (NumPy for the simulation,
+matplotlib only for plots, which are written to files with the non-interactive Agg backend, and pygame
+only for the demo).
+"""
+import argparse
+import json
+import sys
+
+# name -> matchmaker instance in core.matchmakers
+MATCHMAKERS = {
+    "simple": "simple_matchmaker",
+    "advanced": "advanced_matchmaker",
+    "advanced2": "advanced_matchmaker2",
+    "fair": "fair_matchmaker",
+    "batch": "batch_matchmaker",
+    "incremental": "incremental_matchmaker",
+    "balanced_fair": "balanced_fair_matchmaker",
+    "balanced_batch": "balanced_batch_matchmaker",
+}
+ENVIRONMENTS = ["simple", "advanced"]
+MMR_ENGINES = ["base", "cheating", "glicko"]
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m core", description="Matchmaking simulations",
+                                     epilog="Run from the repository root, where the core package is.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    simulate = commands.add_parser("simulate", help="run one simulation and print its statistics")
+    _add_setup_arguments(simulate)
+    simulate.add_argument("--matchmaker", choices=MATCHMAKERS, default="fair")
+    simulate.add_argument("--seed", type=int, default=None)
+    simulate.add_argument("--tick", action="store_true", help="run every round instead of skipping idle ones")
+    simulate.add_argument("--replays", metavar="DIR", help="write the replays to a columnar replay directory")
+    simulate.add_argument("--snapshot", metavar="PATH", help="save an engine snapshot at the end")
+    simulate.add_argument("--plot", metavar="PATH", help="write the statistics plots to an image file")
+    simulate.add_argument("--budget-ms", type=float, default=None, help="time budget of each round's lobby search")
+    simulate.set_defaults(handler=_simulate)
+
+    compare = commands.add_parser("compare", help="compare matchmakers over seeded replicates")
+    _add_setup_arguments(compare)
+    compare.add_argument("--matchmakers", nargs="+", choices=MATCHMAKERS, default=["fair", "advanced2"])
+    compare.add_argument("--replicates", type=int, default=10)
+    compare.add_argument("--processes", type=int, default=None)
+    compare.add_argument("--seed", type=int, default=0)
+    compare.set_defaults(handler=_compare)
+
+    sweep = commands.add_parser("sweep", help="grid or random search over matchmaker and environment settings")
+    sweep.add_argument("matchmaker", help="one of core.sweep.MATCHMAKERS")
+    sweep.add_argument("--param", action="append", default=[], metavar="NAME=V1,V2,...")
+    sweep.add_argument("--env", action="append", default=[], metavar="NAME=V1,V2,...")
+    sweep.add_argument("--random", type=int, default=None, metavar="N", help="N random points instead of the grid")
+    sweep.add_argument("--seed", type=int, default=0)
+    sweep.add_argument("--rounds", type=int, default=5000)
+    sweep.add_argument("--replicates", type=int, default=3)
+    sweep.add_argument("--processes", type=int, default=None)
+    sweep.add_argument("--cache-dir", default=".sweep_cache")
+    sweep.set_defaults(handler=_sweep)
+
+    demo = commands.add_parser("demo", help="show the queue with pygame")
+    _add_setup_arguments(demo, environment="simple", players=100, mmr_engine="cheating")
+    demo.add_argument("--matchmaker", choices=MATCHMAKERS, default="advanced2")
+    demo.add_argument("--wait-ms", type=int, default=100)
+    demo.add_argument("--fps", type=int, default=30)
+    demo.add_argument("--skip-rounds", type=int, default=60)
+    demo.add_argument("--headless", action="store_true")
+    demo.add_argument("--frames", metavar="DIR", help="write every frame to DIR as an image sequence")
+    demo.add_argument("--num-frames", type=int, default=None)
+    demo.add_argument("--color-step", type=int, default=1,
+                      help="shade the bars in steps of this many rounds of waiting, to redraw them less often")
+    demo.set_defaults(handler=_demo)
+
+    export = commands.add_parser("export", help="export a replay directory to CSV and/or plots")
+    export.add_argument("replays", metavar="DIR")
+    export.add_argument("--csv", metavar="PATH")
+    export.add_argument("--plot", metavar="PATH", help="write histograms of the replay columns to an image file")
+    export.set_defaults(handler=_export)
+
+    record = commands.add_parser("record", help="record an environment trace to replay with --trace")
+    record.add_argument("path")
+    record.add_argument("--players", type=int, default=1000)
+    record.add_argument("--active", type=int, default=None, help="players active from the start")
+    record.add_argument("--games-per-player", type=int, default=32)
+    record.add_argument("--seed", type=int, default=None)
+    record.set_defaults(handler=_record)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+def _add_setup_arguments(parser, environment="advanced", players=1000, mmr_engine="base"):
+    parser.add_argument("--environment", choices=ENVIRONMENTS, default=environment)
+    parser.add_argument("--players", type=int, default=players)
+    parser.add_argument("--active", type=int, default=None, help="players active from the start (advanced)")
+    parser.add_argument("--mmr-engine", choices=MMR_ENGINES, default=mmr_engine)
+    parser.add_argument("--rounds", type=int, default=5000)
+    parser.add_argument("--trace", metavar="PATH", help="replay a recorded trace instead of the environment")
+
+
+def _simulate(args):
+    import random
+    import numpy
+    from core.engine import Engine, DataStore
+    from core.runner import summarize, METRICS
+    if args.seed is not None:
+        random.seed(args.seed)
+        numpy.random.seed(args.seed)
+    replay_sink = None
+    if args.replays is not None:
+        from core.replay_store import ReplayWriter
+        replay_sink = ReplayWriter(args.replays)
+    environment = _environment(args)()
+    engine = Engine(_matchmaker(args.matchmaker), _mmr_engine(args.mmr_engine, environment), environment,
+                    DataStore(replay_sink, keep_replays=args.snapshot is not None), args.budget_ms)
+    engine.run(args.rounds, event_driven=not args.tick)
+    engine.close()
+    stats = engine.statistics(list(engine.players.values()))
+    summary = summarize(stats)
+    for metric in METRICS:
+        print(metric + ": " + str(summary[metric]))
+    # p95_queue_time is one of METRICS
+    for percentile, value in stats.wait_times.percentiles((50, 99)).items():
+        print(percentile + "_queue_time: " + str(value))
+    if engine.budget_metrics is not None:
+        for metric, value in engine.budget_metrics.summary().items():
+            print("matchmaking_" + metric + ": " + str(value))
+    if args.snapshot is not None:
+        from core.snapshot import save_snapshot
+        save_snapshot(engine, args.snapshot)
+    if args.plot is not None:
+        from core.runner import plot
+        plot([stats], args.plot)
+
+
+def _compare(args):
+    from core.runner import Runner
+    runs = []
+    for name in args.matchmakers:
+        mmr_engine = _mmr_engine(args.mmr_engine, None)
+        runs.append((name, _matchmaker(name), _environment(args), mmr_engine))
+    Runner(num_rounds=args.rounds).compare(runs, args.replicates, args.processes, args.seed)
+
+
+def _sweep(args):
+    from core.sweep import Sweep
+    sweep = Sweep(args.matchmaker, _grid(args.param), _grid(args.env), args.rounds, args.replicates, args.cache_dir)
+    configs = sweep.grid() if args.random is None else sweep.random(args.random, args.seed)
+    sweep.run(configs, args.processes)
+
+
+def _demo(args):
+    from core.demo import Demo
+    environment = _environment(args)()
+    demo = Demo(wait_ms=args.wait_ms, bar_height=10, bg_color=(30, 30, 80), fps=args.fps, headless=args.headless,
+                frames_dir=args.frames, color_step=args.color_step)
+    demo.run(_matchmaker(args.matchmaker), _mmr_engine(args.mmr_engine, environment), environment,
+             skip_rounds=args.skip_rounds, num_frames=args.num_frames)
+
+
+def _export(args):
+    import numpy
+    from core.replay_store import ReplayReader, COLUMNS
+    reader = ReplayReader(args.replays)
+    if args.csv is not None:
+        header, columns, formats = [], [], []
+        for column, (dtype, width) in COLUMNS.items():
+            values = reader.columns[column].reshape(len(reader), width)
+            header.extend([column] if width == 1 else [column + "_" + str(i + 1) for i in range(width)])
+            columns.append(values)
+            formats.extend(["%.2f" if numpy.issubdtype(dtype, numpy.floating) else "%d"] * width)
+        numpy.savetxt(args.csv, numpy.hstack(columns) if len(columns) > 0 else [], fmt=formats, delimiter=",",
+                      header=",".join(header), comments="")
+    if args.plot is not None:
+        from core.runner import pyplot
+        plt = pyplot(interactive=False)
+        num_players = int(max(reader.team_1.max(initial=-1), reader.team_2.max(initial=-1))) + 1
+        for i, (title, values) in enumerate([("max MMR-diff", reader.max_mmr_diff), ("avg MMR-diff", reader.mmr_diff),
+                                             ("game length", reader.length),
+                                             ("win-rate", reader.win_rates(num_players))]):
+            plt.subplot(2, 2, i + 1)
+            plt.title(title)
+            plt.hist(values, bins=20)
+        plt.savefig(args.plot)
+        plt.close()
+    print(str(len(reader)) + " replays")
+
+
+def _record(args):
+    import numpy
+    from core.trace import record_trace
+    if args.seed is not None:
+        numpy.random.seed(args.seed)
+    active = args.active if args.active is not None else args.players // 5
+    trace = record_trace(args.players, active, args.games_per_player)
+    trace.save(args.path)
+    print(str(trace.num_players) + " players, " + str(len(trace.outcome_noise)) + " games")
+
+
+def _matchmaker(name: str):
+    import core.matchmakers
+    return getattr(core.matchmakers, MATCHMAKERS[name])
+
+
+def _environment(args):
+    from functools import partial
+    from core.environments import SimpleEnvironment, AdvancedEnvironment
+    if args.trace is not None:
+        from core.trace import TraceEnvironment
+        return partial(TraceEnvironment.from_file, args.trace)
+    if args.environment == "simple":
+        return partial(SimpleEnvironment, args.players)
+    active = args.active if args.active is not None else args.players // 5
+    return partial(AdvancedEnvironment, args.players, active)
+
+
+def _mmr_engine(name: str, environment):
+    """An MMR engine; the cheating one is returned as a factory when there is no environment yet."""
+    from core.mmr_engine import BaseMmrEngine, CheatingMmrEngine, GlickoMmrEngine
+    if name == "cheating":
+        return CheatingMmrEngine if environment is None else CheatingMmrEngine(environment)
+    return GlickoMmrEngine() if name == "glicko" else BaseMmrEngine()
+
+
+def _grid(specs):
+    grid = dict()
+    for spec in specs:
+        if "=" not in spec:
+            raise Exception("Bad argument: " + spec)
+        name, values = spec.split("=", 1)
+        grid[name] = [_value(v) for v in values.split(",")]
+    return grid
+
+
+def _value(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
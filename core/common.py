@@ -1,21 +1,45 @@
-from typing import List, Any
+from collections import Counter
+from itertools import islice
+from typing import List, Any, Optional
 from abc import abstractmethod
+from core.mmr_index import MmrIndex
 
 DEBUG = False
 
 
+class Clock:
+    __slots__ = ("round",)
+
+    def __init__(self):
+        self.round = 0
+
+
 class Player:
-    def __init__(self, name: str, mmr: int):
+    __slots__ = ("id", "name", "mmr", "replays")
+
+    def __init__(self, name: str, mmr: int, player_id: int = None):
+        self.id = player_id
         self.name = name
         self.mmr = int(mmr)
         self.replays = []
 
+    def __getstate__(self):
+        # replays link players to each other; pickling them here would recurse through the whole population
+        return self.id, self.name, self.mmr
+
+    def __setstate__(self, state):
+        self.id, self.name, self.mmr = state
+        self.replays = []
+
     def __repr__(self):
         return self.name + "(" + str(self.mmr) + ")"
 
 
 class Replay:
-    def __init__(self, team_1: list, team_2: list, winner_ind: int, game_length: int):
+    __slots__ = ("team_1", "team_2", "winner_team", "mmr_diff", "max_mmr_diff", "winner_ind", "game_length",
+                 "timestamp")
+
+    def __init__(self, team_1: list, team_2: list, winner_ind: int, game_length: int, timestamp: int = None):
         self.team_1 = team_1
         self.team_2 = team_2
         self.winner_team = (team_1, team_2)[winner_ind]
@@ -23,30 +47,117 @@ class Replay:
         self.max_mmr_diff = max_mmr_diff(team_1, team_2)
         self.winner_ind = winner_ind
         self.game_length = game_length
+        self.timestamp = timestamp
 
     def __repr__(self):
         return "mmr diff: " + str(self.mmr_diff)
 
 
 class Queuer:
-    def __init__(self, player: Player, waited: int):
+    """A queued player. The wait time is derived from the engine clock instead of being counted up every round."""
+    __slots__ = ("player", "enqueued_at", "_clock")
+
+    def __init__(self, player: Player, clock: Clock):
         self.player = player
-        self.waited = waited
+        self.enqueued_at = clock.round
+        self._clock = clock
+
+    @property
+    def waited(self) -> int:
+        return self._clock.round - self.enqueued_at
 
     def __repr__(self):
         return self.player.__repr__() + "[" + str(self.waited) + "s]"
 
 
+class Queue:
+    """
+    The engine's queue: FIFO order for iteration/indexing, plus an incrementally maintained MMR index.
+    Queuers are kept in an insertion-ordered dict, so membership and removal take constant time.
+    """
+
+    def __init__(self):
+        self._queuers = dict()
+        self._by_player = dict()
+        self.by_mmr = MmrIndex(queuer_mmr)
+        self.version = 0
+
+    def __len__(self):
+        return len(self._queuers)
+
+    def __iter__(self):
+        return iter(self._queuers)
+
+    def __getitem__(self, index):
+        # positions are counted from the head, which is where matchmakers look: getting position i walks
+        # past the i queuers before it, so anything that goes over the queue should iterate it instead
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 0:
+                return list(self._queuers)[index]
+            return list(islice(self._queuers, start, stop, step))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return next(islice(self._queuers, index, None))
+
+    def __contains__(self, queuer):
+        return queuer in self._queuers
+
+    def __repr__(self):
+        return str(list(self._queuers))
+
+    def append(self, queuer: Queuer) -> None:
+        self._queuers[queuer] = None
+        self._by_player[queuer.player] = queuer
+        self.by_mmr.add(queuer)
+        self.version += 1
+
+    def remove(self, queuer: Queuer) -> None:
+        self.remove_many([queuer])
+
+    def remove_many(self, queuers: List[Queuer]) -> None:
+        """Remove e.g. all members of a lobby at once; the MMR index removes them bucket by bucket."""
+        for queuer in queuers:
+            del self._queuers[queuer]
+            if self._by_player.get(queuer.player) is queuer:
+                del self._by_player[queuer.player]
+        self.by_mmr.remove_many(queuers)
+        self.version += 1
+
+    def queuer_of(self, player: Player) -> Optional[Queuer]:
+        return self._by_player.get(player)
+
+    def on_mmr_changed(self, players: List[Player]) -> None:
+        for p in players:
+            queuer = self._by_player.get(p)
+            if queuer is not None:
+                self.by_mmr.update(queuer)
+                self.version += 1
+
+
 class Game:
-    def __init__(self, game_length: int, team_1: List[Player], team_2: List[Player], winner_index: int):
+    """
+    A game_length of None means the game runs until its result is reported (Engine.finish_game).
+    entry is the sequence number of the engine's schedule entry that ends the game, if it has one.
+    """
+    __slots__ = ("length", "start_round", "end_round", "entry", "finished", "team_1", "team_2", "winner_index")
+
+    def __init__(self, game_length: Optional[int], team_1: List[Player], team_2: List[Player], winner_index: int):
         self.length = game_length
-        self.time_left = game_length
+        self.start_round = None
+        self.end_round = None
+        self.entry = None
+        self.finished = False
         self.team_1 = team_1
         self.team_2 = team_2
         self.winner_index = winner_index
 
 
 class Lobby:
+    __slots__ = ("team_1", "team_2")
+
     def __init__(self, team_1: List[Player], team_2: List[Player]):
         self.team_1 = team_1
         self.team_2 = team_2
@@ -57,7 +168,27 @@ class Lobby:
 
 class MatchMaker:
     @abstractmethod
-    def find_lobbies(self, queue: List[Queuer], found_lobby_callback) -> None:
+    def find_lobbies(self, queue: Queue, found_lobby_callback) -> None:
+        pass
+
+    def find_lobbies_within(self, queue: Queue, found_lobby_callback, deadline: float) -> bool:
+        """
+        find_lobbies with a time budget: stop searching soon after time.perf_counter() reaches deadline.
+        Returns False if search work was left, which a resumable matchmaker continues with in the next
+        call. By default the search can't be interrupted and always runs to completion.
+        """
+        self.find_lobbies(queue, found_lobby_callback)
+        return True
+
+    def next_search_in(self, queue: Queue) -> Optional[int]:
+        """
+        Rounds until searching an unchanged queue again could give a different result,
+        or None if only a change to the queue can. Lets the engine skip idle rounds.
+        """
+        return 1
+
+    def close(self) -> None:
+        """Release what the matchmaker holds on to, such as worker processes. Engine.close() calls this."""
         pass
 
 
@@ -71,6 +202,18 @@ class Environment:
     def one_round(self) -> None:
         pass
 
+    def next_event_in(self) -> Optional[int]:
+        """
+        Number of one_round() calls until one of them has an effect (1 = the next one),
+        or None if only finished games can wake the environment up.
+        """
+        return 1
+
+    def skip_rounds(self, num_rounds: int) -> None:
+        """Advance through rounds that next_event_in() has reported to be idle."""
+        for _ in range(num_rounds):
+            self.one_round()
+
     @abstractmethod
     def on_game_finished(self, game: Game) -> None:
         pass
@@ -79,6 +222,9 @@ class Environment:
     def new_game(self, team_1: List[Player], team_2: List[Player]) -> Game:
         pass
 
+    def new_games(self, lobbies: List[Lobby]) -> List[Game]:
+        return [self.new_game(l.team_1, l.team_2) for l in lobbies]
+
     @abstractmethod
     def player_happiness(self, player: Player) -> float:
         pass
@@ -94,16 +240,103 @@ class MmrEngine:
     def on_game_finished(self, game: Game):
         pass
 
+    def on_games_finished(self, games: List[Game]) -> None:
+        """Called with all games that finish in a round, so that an engine can rate them in one batch."""
+        for game in games:
+            self.on_game_finished(game)
+
     @abstractmethod
     def initial_mmr(self, player_name: str):
         pass
 
 
+class Histogram:
+    """
+    Fixed-width bins plus an exact count and sum; can be merged, and memory doesn't grow with the sample count.
+    With `precision` (a power of two), it is a log-linear (HDR-style) sketch instead: bins are exact up to
+    2 * precision bin widths and above that, each power of two is split into `precision` bins, so quantiles
+    are within 1 / precision of the true value whatever the range of the values.
+    """
+
+    def __init__(self, bin_width: int = 1, precision: int = None):
+        self.bin_width = bin_width
+        self.precision = precision
+        self.count = 0
+        self.total = 0
+        self._bins = Counter()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value, count: int = 1) -> None:
+        self._bins[self._bin(value // self.bin_width)] += count
+        self.count += count
+        self.total += value * count
+
+    def merge(self, other: 'Histogram') -> None:
+        if other.bin_width != self.bin_width or other.precision != self.precision:
+            raise Exception("Bad argument: bin width " + str(other.bin_width) + ", precision " + str(other.precision))
+        self._bins.update(other._bins)
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else -1
+
+    def values(self) -> List[int]:
+        return [b * self.bin_width for b in sorted(self._bins)]
+
+    def counts(self) -> List[int]:
+        return [self._bins[b] for b in sorted(self._bins)]
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Middle of the bin holding the q-quantile (0 <= q <= 1), or None if empty."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for b in sorted(self._bins):
+            seen += self._bins[b]
+            if seen > rank:
+                half = (self._width(b) - 1) / 2.0
+                return (b + half if b >= 0 else b - half) * self.bin_width
+        return None
+
+    def percentiles(self, ps=(50, 95, 99)) -> dict:
+        return {"p" + str(p): self.quantile(p / 100.0) for p in ps}
+
+    def to_dict(self) -> dict:
+        """A JSON-friendly form, e.g. to merge the sketches of parallel runs."""
+        return {"bin_width": self.bin_width, "precision": self.precision, "count": self.count, "total": self.total,
+                "bins": {str(b): c for b, c in self._bins.items()}}
+
+    @staticmethod
+    def from_dict(d: dict) -> 'Histogram':
+        histogram = Histogram(d["bin_width"], d["precision"])
+        histogram.count = d["count"]
+        histogram.total = d["total"]
+        histogram._bins = Counter({int(b): c for b, c in d["bins"].items()})
+        return histogram
+
+    def _bin(self, scaled: int) -> int:
+        if self.precision is None:
+            return scaled
+        if scaled < 0:
+            return -self._bin(-scaled)
+        shift = max(0, scaled.bit_length() - self.precision.bit_length())
+        return scaled >> shift << shift
+
+    def _width(self, b: int) -> int:
+        if self.precision is None:
+            return 1
+        return 1 << max(0, abs(b).bit_length() - self.precision.bit_length())
+
+
 class Statistics:
     def __init__(self,
-                 mmr_diffs: List[int],
-                 wait_times: List[int],
-                 game_lengths: List[int],
+                 mmr_diffs: Histogram,
+                 wait_times: Histogram,
+                 game_lengths: Histogram,
                  win_rates: List[float],
                  num_games: int,
                  avg_queue_time: float,
@@ -122,6 +355,14 @@ class Statistics:
         self.queue = queue
 
 
+def queuer_mmr(queuer: Queuer) -> int:
+    return queuer.player.mmr
+
+
+def player_mmr(player: Player) -> int:
+    return player.mmr
+
+
 def avg_mmr(players: List[Player]) -> float:
     return sum([p.mmr for p in players]) / float(len(players))
 
@@ -1,17 +1,38 @@
+import os
+from itertools import islice
+from time import perf_counter
 from typing import List
 
 import pygame
 import sys
 
-from core.common import Environment, MatchMaker, Game, Queuer, max_mmr_diff, avg, avg_mmr, MmrEngine
+from core.common import Environment, MatchMaker, Game, Queuer, Player, max_mmr_diff, avg, avg_mmr, MmrEngine
 from core.engine import Engine, OnGameFinishedListener, OnLobbyFoundListener
 
 TEAM_SIZE = 5
+WIDTH_DIVIDER = 8
+BAR_X = 10
+BAR_SPACE = 1
+TOP_SPACE = 50
 
 
 class Demo(OnGameFinishedListener, OnLobbyFoundListener):
-
-    def __init__(self, width=800, height=600, bar_height=10, wait_ms=100, bg_color=(50, 50, 50), text_color=(255, 255, 255)):
+    """
+    Draws the queue at a fixed frame rate, while the simulation runs one round per wait_ms (UP/DOWN
+    change it) independently of the drawing. Only queue bars and texts that changed since the last
+    frame are redrawn, and only as many bars as fit on the screen. A bar's color shades with every round
+    of waiting, so waiting bars change every round; with color_step, the shade changes every color_step
+    rounds instead, and the bars are redrawn that much less often.
+
+    In headless mode nothing is shown and the simulation isn't throttled: every frame advances the
+    simulation by the rounds that fit in 1000 / fps ms, and with frames_dir set, frames are written
+    there as an image sequence (frame_000000.png, ...).
+    """
+
+    def __init__(self, width=800, height=600, bar_height=10, wait_ms=100, bg_color=(50, 50, 50), text_color=(255, 255, 255),
+                 fps=30, headless=False, frames_dir=None, color_step=1):
+        if headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
         pygame.init()
         self.width = width
         self.height = height
@@ -23,41 +44,53 @@ class Demo(OnGameFinishedListener, OnLobbyFoundListener):
         self.bg_color = bg_color
         self.font = pygame.font.Font(None, 22)
         self.text_color = text_color
+        self.fps = fps
+        self.headless = headless
+        self.frames_dir = frames_dir
+        self.color_step = color_step
         self.num_playing = 0
+        self.num_frames = 0
         self._currently_skipping_rounds = False
+        self._clock = pygame.time.Clock()
+        self._rounds_due = 0.0
+        self._skills = dict()
+        self._rows = []
+        self._texts = dict()
+        self._text_surfaces = dict()
 
     def on_lobby_found(self, team_1: List[Queuer], team_2: List[Queuer]) -> None:
         self.num_playing += TEAM_SIZE * 2
+        if self._currently_skipping_rounds:
+            return
         avg_mmr_diff = int(avg_mmr([q.player for q in team_2]) - avg_mmr([q.player for q in team_1]))
         max_mmr_d = max_mmr_diff([q.player for q in team_1], [q.player for q in team_2])
-        names = [q.player.name for q in team_1 + team_2]
-        skills = [self.environment.get_player_skill(name) for name in names]
+        skills = [self._skill(q.player) for q in team_1 + team_2]
         max_skill_d = max(skills) - min(skills)
-        if not self._currently_skipping_rounds:
-            print("New game: max diff: " + str(max_mmr_d) +
-                  ", avg diff: " + str(avg_mmr_diff) +
-                  ", max skill diff: " + str(max_skill_d) +
-                  ", avg wait: " + str(avg([q.waited for q in team_1 + team_2])))
+        print("New game: max diff: " + str(max_mmr_d) +
+              ", avg diff: " + str(avg_mmr_diff) +
+              ", max skill diff: " + str(max_skill_d) +
+              ", avg wait: " + str(avg([q.waited for q in team_1 + team_2])))
 
     def on_game_finished(self, game: Game) -> None:
         self.num_playing -= TEAM_SIZE * 2
 
-    def run(self, match_maker: MatchMaker, mmr_engine: MmrEngine, environment: Environment, skip_rounds: int = 0):
+    def run(self, match_maker: MatchMaker, mmr_engine: MmrEngine, environment: Environment, skip_rounds: int = 0,
+            num_frames: int = None):
 
         self.engine = Engine(match_maker, mmr_engine, environment)
-        self.engine._on_game_finished_listeners.append(self)
-        self.engine._on_lobby_found_listeners.append(self)
+        self.engine.add_on_game_finished_listener(self)
+        self.engine.add_on_lobby_found_listener(self)
         self.environment = environment
-        self._main_loop(skip_rounds)
+        self._main_loop(skip_rounds, num_frames)
 
-    def _main_loop(self, skip_rounds: int):
+    def _main_loop(self, skip_rounds: int, num_frames: int):
         self._currently_skipping_rounds = True
-        for i in range(skip_rounds):
-            self.engine.one_round()
+        self.engine.run(skip_rounds, event_driven=True)
         self._currently_skipping_rounds = False
-        self._render()
-        pygame.time.wait(1000)
-        while True:
+        self._render_all()
+        if not self.headless:
+            pygame.time.wait(1000)
+        while num_frames is None or self.num_frames < num_frames:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     sys.exit()
@@ -69,44 +102,108 @@ class Demo(OnGameFinishedListener, OnLobbyFoundListener):
                             self.wait_ms = int(self.wait_ms * 1.5)
                     elif event.key == pygame.K_UP:
                         self.wait_ms = int(self.wait_ms / 1.5)
-            self.engine.one_round()
-            pygame.time.wait(self.wait_ms)
+            self._simulate(1000.0 / self.fps)
             self._render()
+            if not self.headless:
+                self._clock.tick(self.fps)
+
+    def _simulate(self, frame_ms: float):
+        if self.headless:
+            rounds = 1 if self.wait_ms == 0 else frame_ms / self.wait_ms
+            self._rounds_due += rounds
+            while self._rounds_due >= 1:
+                self.engine.one_round()
+                self._rounds_due -= 1
+            return
+        # at most half a frame goes to the simulation; a backlog it can't catch up on is dropped
+        deadline = perf_counter() + frame_ms / 2000.0
+        self._rounds_due = self._rounds_due + frame_ms / self.wait_ms if self.wait_ms > 0 else float("inf")
+        while self._rounds_due >= 1 and perf_counter() < deadline:
+            self.engine.one_round()
+            self._rounds_due -= 1
+        self._rounds_due = min(self._rounds_due, 1.0)
 
-    def _render(self):
+    def _render_all(self):
         pygame.draw.rect(self.screen, self.bg_color, (0, 0, self.width, self.height))
-        for i, queuer in enumerate(self.engine.queue()):
-            width_divider = 8
-            w = queuer.player.mmr / width_divider
-            line_x = self.environment.get_player_skill(queuer.player.name) / width_divider
-            line_color = (255, 255, 255)
-            x = 10
-            space = 1
-            top_space = 50
-            y = top_space + i * (self.bar_height + space)
-            rect = (x, y, w, self.bar_height)
-            if queuer.waited < 255:
-                color = (queuer.waited, 0, 255-queuer.waited)
-            else:
-                color = (255, 0, 0)
-            pygame.draw.rect(self.screen, color, rect)
-            pygame.draw.rect(self.screen, line_color, (x + line_x, y, 3, self.bar_height))
-
-        longest_wait = 0
-        if len(self.engine.queue()) > 0:
-            longest_wait = self.engine.queue()[0].waited
-
-        self._render_text(str(len(self.engine.queue())) + " queueing", 10)
-        self._render_text("longest: " + str(longest_wait) + "s", 150)
-        self._render_text(str(len(self.engine._data_store.replays)) + " games played", 310)
-        self._render_text(str(self.wait_ms) + "ms / round", 450)
-        self._render_text(str(self.num_playing) + " playing", 610)
-
+        self._rows = [None] * max(0, (self.height - TOP_SPACE) // (self.bar_height + BAR_SPACE))
+        self._texts = dict()
+        self._render()
         pygame.display.flip()
 
-    def _render_text(self, msg, x):
-        text = self.font.render(msg, 1, self.text_color)
+    def _render(self):
+        dirty = []
+        queue = self.engine.queue()
+        visible = list(islice(queue, len(self._rows)))
+        for i in range(len(self._rows)):
+            row = self._row(visible[i]) if i < len(visible) else None
+            if row != self._rows[i]:
+                dirty.append(self._render_row(i, row))
+                self._rows[i] = row
+
+        longest_wait = 0
+        if len(queue) > 0:
+            longest_wait = next(iter(queue)).waited
+
+        dirty.extend(self._render_text(str(len(queue)) + " queueing", 10))
+        dirty.extend(self._render_text("longest: " + str(longest_wait) + "s", 150))
+        dirty.extend(self._render_text(str(self.engine._data_store.aggregator.num_games) + " games played", 310))
+        dirty.extend(self._render_text(str(self.wait_ms) + "ms / round", 450))
+        dirty.extend(self._render_text(str(self.num_playing) + " playing", 610))
+        percentiles = self.engine._data_store.aggregator.wait_times.percentiles()
+        dirty.extend(self._render_text("wait " + ", ".join(p + ": " + _format_wait(v) for p, v in percentiles.items()),
+                                       10, 28))
+
+        if len(dirty) > 0:
+            pygame.display.update(dirty)
+        if self.frames_dir is not None:
+            os.makedirs(self.frames_dir, exist_ok=True)
+            pygame.image.save(self.screen, os.path.join(self.frames_dir, "frame_%06d.png" % self.num_frames))
+        self.num_frames += 1
+
+    def _row(self, queuer: Queuer):
+        if queuer.waited < 255:
+            shade = queuer.waited // self.color_step * self.color_step
+            color = (shade, 0, 255 - shade)
+        else:
+            color = (255, 0, 0)
+        return queuer, int(queuer.player.mmr / WIDTH_DIVIDER), color, int(self._skill(queuer.player) / WIDTH_DIVIDER)
+
+    def _render_row(self, i: int, row) -> pygame.Rect:
+        y = TOP_SPACE + i * (self.bar_height + BAR_SPACE)
+        area = pygame.Rect(0, y, self.width, self.bar_height)
+        pygame.draw.rect(self.screen, self.bg_color, area)
+        if row is not None:
+            _, w, color, line_x = row
+            pygame.draw.rect(self.screen, color, (BAR_X, y, w, self.bar_height))
+            pygame.draw.rect(self.screen, (255, 255, 255), (BAR_X + line_x, y, 3, self.bar_height))
+        return area
+
+    def _render_text(self, msg, x, y=10) -> List[pygame.Rect]:
+        previous = self._texts.get((x, y))
+        if previous is not None and previous[0] == msg:
+            return []
+        if msg not in self._text_surfaces:
+            if len(self._text_surfaces) > 1000:
+                self._text_surfaces.clear()
+            self._text_surfaces[msg] = self.font.render(msg, 1, self.text_color)
+        text = self._text_surfaces[msg]
         textpos = text.get_rect()
         textpos.x = x
-        textpos.y = 10
-        self.screen.blit(text, textpos)
\ No newline at end of file
+        textpos.y = y
+        dirty = [textpos]
+        if previous is not None:
+            pygame.draw.rect(self.screen, self.bg_color, previous[1])
+            dirty.append(previous[1])
+        self.screen.blit(text, textpos)
+        self._texts[(x, y)] = (msg, textpos)
+        return dirty
+
+    def _skill(self, player: Player) -> int:
+        # skills don't change, so each player's is looked up once
+        if player not in self._skills:
+            self._skills[player] = self.environment.get_player_skill(player.name)
+        return self._skills[player]
+
+
+def _format_wait(seconds) -> str:
+    return "-" if seconds is None else str(int(seconds)) + "s"
@@ -1,6 +1,15 @@
 from abc import abstractmethod
-from typing import List, Any
-from core.common import Player, Queuer, Replay, Game, debug, MatchMaker, Environment, Statistics, Lobby, avg, MmrEngine
+from array import array
+from heapq import heappush, heappop
+from time import perf_counter
+from typing import List, Any, Optional
+
+import numpy
+
+from core.common import Player, Queuer, Replay, Game, debug, MatchMaker, Environment, Statistics, Lobby, MmrEngine, \
+    Queue, Clock, Histogram, player_mmr
+from core.matchmakers import TEAM_SIZE
+from core.mmr_index import MmrIndex
 
 
 class OnGameFinishedListener:
@@ -15,66 +24,333 @@ class OnLobbyFoundListener:
         pass
 
 
-class DataStore:
+# sub-bins per power of two of the wait time, MMR spread and game length sketches
+SKETCH_PRECISION = 32
+
+
+def wait_time_sketch() -> Histogram:
+    return Histogram(1, SKETCH_PRECISION)
+
+
+def mmr_diff_sketch() -> Histogram:
+    return Histogram(10, SKETCH_PRECISION)
+
+
+def game_length_sketch() -> Histogram:
+    return Histogram(1, SKETCH_PRECISION)
+
+
+class PlayerAggregate:
+    __slots__ = ("games", "wins", "wait_times", "game_ids")
+
     def __init__(self):
-        self.wait_times = dict()
+        self.games = 0
+        self.wins = 0
+        self.wait_times = wait_time_sketch()
+        # numbers of the games played, to count each game of a cohort once
+        self.game_ids = array("q")
+
+
+class StatisticsAggregator:
+    """
+    Streams finished games and wait times into per-player counts, sums and histograms, and keeps
+    all players in an MMR index. Statistics for an MMR-range cohort are then merged from the
+    cohort's aggregates, without rescanning the replay history: wait times from the players' sketches,
+    MMR spreads and game lengths from a compact record per game, counting each game with any cohort
+    player in it once.
+
+    The histograms are quantile sketches of bounded size. Sketches over all players (wait times once per
+    matched player, MMR spreads and game lengths once per game) are kept up to date as well, for live
+    percentiles and the statistics of the whole population.
+    """
+
+    def __init__(self):
+        self.num_games = 0
+        self.wait_times = wait_time_sketch()
+        self.mmr_diffs = mmr_diff_sketch()
+        self.game_lengths = game_length_sketch()
+        self._by_mmr = MmrIndex(player_mmr)
+        self._aggregates = dict()
+        self._game_mmr_diffs = array("q")
+        self._game_lengths = array("q")
+
+    def on_player_added(self, player: Player) -> None:
+        self._by_mmr.add(player)
+        self._aggregates[player] = PlayerAggregate()
+
+    def on_mmr_changed(self, players: List[Player]) -> None:
+        for p in players:
+            self._by_mmr.update(p)
+
+    def on_replay(self, replay: Replay) -> None:
+        game_id = self.num_games
+        self.num_games += 1
+        self.mmr_diffs.add(replay.max_mmr_diff)
+        self.game_lengths.add(replay.game_length)
+        self._game_mmr_diffs.append(replay.max_mmr_diff)
+        self._game_lengths.append(replay.game_length)
+        for i, team in enumerate((replay.team_1, replay.team_2)):
+            for p in team:
+                aggregate = self._aggregates[p]
+                aggregate.games += 1
+                if i == replay.winner_ind:
+                    aggregate.wins += 1
+                aggregate.game_ids.append(game_id)
+
+    def games_played(self, player: Player) -> int:
+        return self._aggregates[player].games
+
+    def win_rate(self, player: Player) -> float:
+        aggregate = self._aggregates[player]
+        return aggregate.wins / float(aggregate.games) if aggregate.games > 0 else 0.0
+
+    def on_wait_time(self, player: Player, wait_time: int) -> None:
+        self.wait_times.add(wait_time)
+        self._aggregates[player].wait_times.add(wait_time)
+
+    def players_with_mmr_between(self, min_mmr: int, max_mmr: int) -> List[Player]:
+        return self._by_mmr.between(min_mmr, max_mmr)
+
+    def statistics(self, players: List[Player], queue: Queue) -> Statistics:
+        wait_times = wait_time_sketch()
+        win_rates = []
+        game_ids = []
+        for p in players:
+            aggregate = self._aggregates[p]
+            wait_times.merge(aggregate.wait_times)
+            game_ids.append(numpy.frombuffer(aggregate.game_ids, dtype=numpy.int64))
+            if aggregate.games > 0:
+                win_rates.append(aggregate.wins / float(aggregate.games))
+        if len(set(players)) == len(self._aggregates):
+            mmr_diffs = self.mmr_diffs
+            game_lengths = self.game_lengths
+        else:
+            game_ids = numpy.unique(numpy.concatenate(game_ids)) if len(game_ids) > 0 else []
+            mmr_diffs = _sketch_of(mmr_diff_sketch(), self._game_mmr_diffs, game_ids)
+            game_lengths = _sketch_of(game_length_sketch(), self._game_lengths, game_ids)
+        return Statistics(mmr_diffs, wait_times, game_lengths, win_rates, self.num_games, wait_times.mean(),
+                          mmr_diffs.mean(), game_lengths.mean(), queue)
+
+
+def _sketch_of(sketch: Histogram, per_game: array, game_ids) -> Histogram:
+    values = numpy.frombuffer(per_game, dtype=numpy.int64)[game_ids]
+    for value, count in zip(*numpy.unique(values, return_counts=True)):
+        sketch.add(int(value), int(count))
+    return sketch
+
+
+class DataStore:
+    """
+    With keep_replays=False, replays are only streamed to the aggregator and the optional replay_sink
+    (e.g. a ReplayWriter), and are no longer kept in memory here or in Player.replays.
+    """
+
+    def __init__(self, replay_sink=None, keep_replays: bool = True):
         self.replays = []
+        self.aggregator = StatisticsAggregator()
+        self.replay_sink = replay_sink
+        self.keep_replays = keep_replays
 
     def store_replay(self, replay):
-        self.replays.append(replay)
+        if self.keep_replays:
+            self.replays.append(replay)
+        if self.replay_sink is not None:
+            self.replay_sink.write(replay)
+        self.aggregator.on_replay(replay)
+
+    def close(self):
+        if self.replay_sink is not None:
+            self.replay_sink.close()
 
     def store_wait_time(self, player, wait_time):
-        self._add_mapping(self.wait_times, player, wait_time)
+        self.aggregator.on_wait_time(player, wait_time)
+
 
-    @staticmethod
-    def _add_mapping(the_dict: dict, key, value):
-        array = DataStore._put_if_absent(the_dict, key, [])
-        array.append(value)
+class BudgetMetrics:
+    """
+    How matchmaking kept to the engine's time budget: the time of each search (in microseconds), how
+    many searches overran the budget and by how much, and how many left work for the next round.
+    """
 
-    @staticmethod
-    def _put_if_absent(the_dict: dict, key, default):
-        if key in the_dict:
-            return the_dict[key]
-        the_dict[key] = default
-        return default
+    def __init__(self, budget_ms: float):
+        self.budget_ms = budget_ms
+        self.searches = 0
+        self.overruns = 0
+        self.deferred = 0
+        self.search_us = Histogram(1, SKETCH_PRECISION)
+        self.overrun_us = Histogram(1, SKETCH_PRECISION)
+
+    def on_search(self, seconds: float, finished: bool) -> None:
+        self.searches += 1
+        micros = int(seconds * 1e6)
+        self.search_us.add(micros)
+        overrun = micros - int(self.budget_ms * 1000)
+        if overrun > 0:
+            self.overruns += 1
+            self.overrun_us.add(overrun)
+        if not finished:
+            self.deferred += 1
+
+    def summary(self) -> dict:
+        return {
+            "budget_ms": self.budget_ms,
+            "searches": self.searches,
+            "overruns": self.overruns,
+            "deferred": self.deferred,
+            "search_us": self.search_us.percentiles(),
+            "overrun_us": self.overrun_us.percentiles(),
+        }
 
 
 class Engine:
+    """
+    With matchmaking_budget_ms, every round's lobby search gets that much time (see
+    MatchMaker.find_lobbies_within); a search that leaves work behind is continued in the next round,
+    and budget_metrics counts overruns and deferred searches.
+    """
 
-    def __init__(self, match_maker: MatchMaker, mmr_engine: MmrEngine, environment: Environment):
+    def __init__(self, match_maker: MatchMaker, mmr_engine: MmrEngine, environment: Environment,
+                 data_store: DataStore = None, matchmaking_budget_ms: float = None):
         self._match_maker = match_maker
         self._mmr_engine = mmr_engine
         self._environment = environment
         self._environment.register_callbacks(self._add_to_queue, self._remove_from_queue)
-        self._queue = []
+        self._queue = Queue()
         self._games = []
+        self._num_games_started = 0
+        self._searched_queue_version = None
+        self._clock = Clock()
         self._lobbies = []
         self.players = dict()
-        self._data_store = DataStore()
+        self._players_by_id = []
+        self._data_store = data_store or DataStore()
         self._on_game_finished_listeners = []
         self._on_lobby_found_listeners = []
+        self.matchmaking_budget_ms = matchmaking_budget_ms
+        self.budget_metrics = BudgetMetrics(matchmaking_budget_ms) if matchmaking_budget_ms is not None else None
+
+    def __getstate__(self):
+        # listeners are usually UI or reporting objects tied to this process; they are not part of a snapshot
+        state = dict(self.__dict__)
+        state["_on_game_finished_listeners"] = []
+        state["_on_lobby_found_listeners"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._data_store.keep_replays:
+            for replay in self._data_store.replays:
+                for p in replay.team_1 + replay.team_2:
+                    p.replays.append(replay)
+
+    def add_on_lobby_found_listener(self, listener: OnLobbyFoundListener) -> None:
+        self._on_lobby_found_listeners.append(listener)
+
+    def add_on_game_finished_listener(self, listener: OnGameFinishedListener) -> None:
+        self._on_game_finished_listeners.append(listener)
 
     def queue(self):
         return self._queue
 
+    @property
+    def round(self) -> int:
+        return self._clock.round
+
+    def player(self, player_id: int) -> Player:
+        return self._players_by_id[player_id]
+
     def one_round(self):
-        for queuer in self._queue:
-            queuer.waited += 1
+        self._clock.round += 1
         self._find_lobbies_and_start_games()
         debug("Queue size: " + str(len(self._queue)))
         debug("...")
         self._progress_games()
         self._environment.one_round()
 
+    def run(self, num_rounds: int, event_driven: bool = False) -> None:
+        """
+        Run num_rounds rounds. In event driven mode, rounds in which nothing can happen (no game ends,
+        no environment event and no matchmaking worth doing) are skipped in one jump; the outcome is the
+        same as calling one_round() for each of them.
+        """
+        end = self.round + num_rounds
+        while self.round < end:
+            if event_driven:
+                next_round = self._next_event_round()
+                if next_round is None or next_round > end:
+                    self._skip_idle_rounds(end - self.round)
+                    return
+                self._skip_idle_rounds(next_round - self.round - 1)
+            self.one_round()
+
+    def _next_event_round(self) -> Optional[int]:
+        candidates = []
+        if len(self._games) > 0:
+            candidates.append(self._games[0][0])
+        env_event_in = self._environment.next_event_in()
+        if env_event_in is not None:
+            candidates.append(self.round + env_event_in)
+        if len(self._queue) >= TEAM_SIZE * 2:
+            if self._queue.version != self._searched_queue_version:
+                candidates.append(self.round + 1)
+            else:
+                search_in = self._match_maker.next_search_in(self._queue)
+                if search_in is not None:
+                    candidates.append(self.round + search_in)
+        return min(candidates) if len(candidates) > 0 else None
+
+    def _skip_idle_rounds(self, num_rounds: int):
+        if num_rounds <= 0:
+            return
+        self._clock.round += num_rounds
+        self._environment.skip_rounds(num_rounds)
+
     def _find_lobbies_and_start_games(self):
-        self._match_maker.find_lobbies(self._queue, self._on_found_lobby)
-        for l in self._lobbies:
-            self._games.append(self._environment.new_game(l.team_1, l.team_2))
+        if self.matchmaking_budget_ms is None:
+            self._match_maker.find_lobbies(self._queue, self._on_found_lobby)
+            self._searched_queue_version = self._queue.version
+        else:
+            self._find_lobbies_within_budget()
+        for l, game in zip(self._lobbies, self._environment.new_games(self._lobbies)):
+            self._start_game(game)
             debug("Found game")
             debug(l.team_1)
             debug(l.team_2)
         self._lobbies = []
 
+    def _find_lobbies_within_budget(self):
+        start = perf_counter()
+        finished = self._match_maker.find_lobbies_within(self._queue, self._on_found_lobby,
+                                                          start + self.matchmaking_budget_ms / 1000.0)
+        self.budget_metrics.on_search(perf_counter() - start, finished)
+        # with work left, the next round searches again even if the queue doesn't change
+        self._searched_queue_version = self._queue.version if finished else None
+
+    def _start_game(self, game: Game):
+        game.start_round = self.round
+        # a game without a length runs until finish_game() reports it
+        if game.length is not None:
+            self._schedule(game, self.round + max(game.length, 1) - 1)
+
+    def _schedule(self, game: Game, end_round: int):
+        # an entry of the game pushed before this one is stale from now on and skipped when popped
+        game.end_round = end_round
+        game.entry = self._num_games_started
+        heappush(self._games, (end_round, self._num_games_started, game))
+        self._num_games_started += 1
+
+    def finish_game(self, game: Game, winner_index: int) -> None:
+        """
+        End a running game early, e.g. when its result is reported; it finishes in the next game progress.
+        A game that has already finished is left as it is.
+        """
+        if game.finished:
+            return
+        game.winner_index = winner_index
+        end_round = max(self.round, game.start_round)
+        game.length = end_round - game.start_round + 1
+        self._schedule(game, end_round)
+
     def _add_to_queue(self, player_name: str):
         if not isinstance(player_name, str):
             raise Exception("Bad argument: " + player_name)
@@ -82,9 +358,11 @@ class Engine:
             player = self.players[player_name]
         else:
             mmr = self._mmr_engine.initial_mmr(player_name)
-            player = Player(player_name, mmr)
+            player = Player(player_name, mmr, len(self._players_by_id))
             self.players[player_name] = player
-        self._queue.append(Queuer(player, 0))
+            self._players_by_id.append(player)
+            self._data_store.aggregator.on_player_added(player)
+        self._queue.append(Queuer(player, self._clock))
 
     def _remove_from_queue(self, queuer: Queuer):
         if not isinstance(queuer, Queuer):
@@ -92,63 +370,58 @@ class Engine:
         self._queue.remove(queuer)
 
     def _on_game_finished(self, game: Game) -> None:
-        self._environment.on_game_finished(game)
-        self._mmr_engine.on_game_finished(game)
-        self._games.remove(game)
-        replay = Replay(game.team_1, game.team_2, game.winner_index, game.length)
+        self._queue.on_mmr_changed(game.team_1 + game.team_2)
+        self._data_store.aggregator.on_mmr_changed(game.team_1 + game.team_2)
+        replay = Replay(game.team_1, game.team_2, game.winner_index, game.length, self.round)
         self._data_store.store_replay(replay)
-        for p in game.team_1 + game.team_2:
-            p.replays.append(replay)
+        if self._data_store.keep_replays:
+            for p in game.team_1 + game.team_2:
+                p.replays.append(replay)
         for listener in self._on_game_finished_listeners:
             listener.on_game_finished(game)
 
     def _on_found_lobby(self, team_1: List[Queuer], team_2: List[Queuer]):
-        if not (isinstance(team_1, List[Queuer]) and isinstance(team_2, List[Queuer])):
+        if not (isinstance(team_1, list) and isinstance(team_2, list)):
             raise Exception("Bad arguments: " + str(team_1) + ", " + str(team_2))
 
         lobby = Lobby([q.player for q in team_1], [q.player for q in team_2])
         self._lobbies.append(lobby)
         for queuer in team_1 + team_2:
             self._data_store.store_wait_time(queuer.player, queuer.waited)
-            self._queue.remove(queuer)
+        self._queue.remove_many(team_1 + team_2)
         for listener in self._on_lobby_found_listeners:
             listener.on_lobby_found(team_1, team_2)
 
     def _progress_games(self):
-        for g in list(self._games):
-            g.time_left -= 1
-            if g.time_left == 0:
-                self._on_game_finished(g)
+        finished = []
+        while len(self._games) > 0 and self._games[0][0] <= self.round:
+            _, entry, game = heappop(self._games)
+            # a game ended early by finish_game() leaves its original entry behind
+            if entry == game.entry:
+                game.entry = None
+                game.finished = True
+                finished.append(game)
+        if len(finished) == 0:
+            return
+        for game in finished:
+            self._environment.on_game_finished(game)
+        self._mmr_engine.on_games_finished(finished)
+        for game in finished:
+            self._on_game_finished(game)
 
     def active_players(self):
-        return [p for p in self.players.values() if len(p.replays) > 0]
+        return [p for p in self.players.values() if self._data_store.aggregator.games_played(p) > 0]
 
-    @staticmethod
-    def player_winrate(p: Player) -> float:
-        victories = [1 if p in r.winner_team else 0 for r in p.replays]
-        return sum(victories) / float(len(p.replays))
+    def player_winrate(self, p: Player) -> float:
+        """From the aggregated counts, so it doesn't need the replays to be kept; 0 for a player without games."""
+        return self._data_store.aggregator.win_rate(p)
 
     def players_with_mmr_between(self, min_mmr, max_mmr):
-        return [p for p in self.players.values() if min_mmr <= p.mmr <= max_mmr]
-
-    def statistics(self, players: List[Player]):
-        relevant_replays = [r for r in self._data_store.replays if Engine._replay_contains_some_of(r, players)]
-        wait_time_lists = [v for (k, v) in self._data_store.wait_times.items() if k in players]
-        active = [p for p in players if p in self.active_players()]
-
-        mmr_diffs = [r.max_mmr_diff for r in relevant_replays]
-        wait_times = [w for sub in wait_time_lists for w in sub]
-        game_lengths = [r.game_length for r in relevant_replays]
-        win_rates = [Engine.player_winrate(p) for p in active]
-
-        num_games = len(self._data_store.replays)
-        avg_queue_time = avg(wait_times) if len(wait_times) > 0 else -1
-        avg_max_mmr_diff = avg(mmr_diffs) if len(mmr_diffs) > 0 else -1
-        avg_game_length = avg(game_lengths) if len(game_lengths) > 0 else -1
+        return self._data_store.aggregator.players_with_mmr_between(min_mmr, max_mmr)
 
-        return Statistics(mmr_diffs, wait_times, game_lengths, win_rates, num_games, avg_queue_time,
-                          avg_max_mmr_diff, avg_game_length, self._queue)
+    def statistics(self, players: List[Player]) -> Statistics:
+        return self._data_store.aggregator.statistics(players, self._queue)
 
-    @staticmethod
-    def _replay_contains_some_of(replay: Replay, players: List[Player]):
-        return any(p in (replay.team_1 + replay.team_2) for p in players)
+    def close(self) -> None:
+        self._match_maker.close()
+        self._data_store.close()
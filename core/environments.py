@@ -1,85 +1,148 @@
-import random
-from typing import List
+from heapq import heappush, heappop
+from typing import List, Optional
 import numpy
-from core.common import Player, Replay, debug, Game, Environment, avg
+from core.common import Player, Replay, debug, Game, Environment, avg, Lobby
 
+SLEEPING = 0
+QUEUED = 1
+PLAYING = 2
 
-class AdvancedEnvironment(Environment):
 
-    def __init__(self, num_players: int = 1000, num_active_from_start: int = 200):
-        self._inactive_players = []
-        self._human_index = 1
-        self._humans = dict()
-        self._create_humans(num_players, num_active_from_start)
-        self._add_to_queue = lambda x: None
-        self._remove_from_queue = lambda x: None
-
-    def _create_humans(self, num_humans, num_active_from_start):
-        for i in range(num_humans):
-            h = self._create_human()
-            self._humans[h.name] = h
-            if i < num_active_from_start:
-                self._give_player_short_break(h.name)
-            else:
-                self._give_player_long_break(h.name)
+class AdvancedEnvironment(Environment):
+    """
+    The population is stored as a struct of NumPy arrays indexed by player id ("p-<id + 1>"), so
+    creating it and resolving breaks and game outcomes are vectorized, even for millions of players.
+    """
+
+    def __init__(self, num_players: int = 1000, num_active_from_start: int = 200, random_block_size: int = 4096):
+        self._normals = _RandomBlock("standard_normal", random_block_size)
+        self._uniforms = _RandomBlock("random_sample", random_block_size)
+        skill = numpy.random.normal(2200, 600, num_players).astype(int)
+        max_games = numpy.random.randint(1, 6, num_players)
+        max_time_queue = numpy.random.randint(120, 1201, num_players)
+        num_active_from_start = min(num_active_from_start, num_players)
+        breaks = numpy.concatenate((self._short_breaks(num_active_from_start),
+                                    self._long_breaks(num_players - num_active_from_start)))
+        self._populate(skill, max_games, max_time_queue, breaks)
+
+    def _populate(self, skill: numpy.ndarray, max_games: numpy.ndarray, max_time_queue: numpy.ndarray,
+                  initial_breaks: numpy.ndarray):
+        num_players = len(skill)
+        self._round = 0
+        self._skill = skill
+        self._max_games = max_games
+        self._max_time_queue = max_time_queue
+        self._games_played = numpy.zeros(num_players, dtype=int)
+        self._state = numpy.full(num_players, SLEEPING, dtype=numpy.int8)
+        self._wake_round = numpy.zeros(num_players, dtype=numpy.int64)
+        self._wake_rounds = []
+        self._sleepers = dict()
+        self._add_to_queue = _not_registered
+        self._remove_from_queue = _not_registered
+        self._give_breaks(numpy.arange(num_players), initial_breaks)
 
     def register_callbacks(self, add_to_queue, remove_from_queue):
         self._add_to_queue = add_to_queue
         self._remove_from_queue = remove_from_queue
 
     def get_player_skill(self, player_name):
-        return self._humans[player_name].skill
+        return int(self._skill[_player_id(player_name)])
 
     def one_round(self):
+        self._round += 1
         self._add_players_that_took_a_break()
         self._remove_tired_players_from_queue()
 
-    def _add_new_human(self):
-        new_human = self._create_human()
-        self._humans[new_human.name] = new_human
-        self._add_to_queue(new_human.name)
+    def next_event_in(self) -> Optional[int]:
+        if len(self._wake_rounds) == 0:
+            return None
+        return self._wake_rounds[0] - self._round
+
+    def skip_rounds(self, num_rounds: int) -> None:
+        self._round += num_rounds
 
     def _add_players_that_took_a_break(self):
-        for inactive in list(self._inactive_players):
-            if inactive.time_until_play == 0:
-                self._inactive_players.remove(inactive)
-                self._add_to_queue(inactive.player_name)
-            else:
-                inactive.time_until_play -= 1
+        while len(self._wake_rounds) > 0 and self._wake_rounds[0] <= self._round:
+            self._wake_earliest_sleepers()
+
+    def top_up_queue(self, queue_size: int) -> None:
+        """Wake the players with the earliest wake rounds early, until at least queue_size players are queued."""
+        missing = queue_size - int(numpy.count_nonzero(self._state == QUEUED))
+        while missing > 0 and len(self._wake_rounds) > 0:
+            missing -= self._wake_earliest_sleepers()
+
+    def _wake_earliest_sleepers(self) -> int:
+        """Queue the players with the earliest wake round, and return how many they were."""
+        ids = numpy.concatenate(self._sleepers.pop(heappop(self._wake_rounds)))
+        self._state[ids] = QUEUED
+        for player_id in ids.tolist():
+            self._add_to_queue(_player_name(player_id))
+        return len(ids)
 
     def _remove_tired_players_from_queue(self):
         pass #TODO
 
-    def _give_player_a_break(self, player_name: str, time_until_queue_again: int):
-        self._inactive_players.append(InactivePlayer(player_name, time_until_queue_again))
+    def _give_breaks(self, ids: numpy.ndarray, breaks: numpy.ndarray):
+        # breaks are counted down from the next call to one_round()
+        wake = self._round + 1 + breaks
+        self._wake_round[ids] = wake
+        self._state[ids] = SLEEPING
+        order = numpy.argsort(wake, kind="stable")
+        rounds, starts = numpy.unique(wake[order], return_index=True)
+        for wake_round, group in zip(rounds.tolist(), numpy.split(ids[order], starts[1:])):
+            if wake_round not in self._sleepers:
+                self._sleepers[wake_round] = []
+                heappush(self._wake_rounds, wake_round)
+            self._sleepers[wake_round].append(group)
 
     def on_game_finished(self, game: Game) -> None:
-        for p in game.team_1 + game.team_2:
-            human = self._humans[p.name]
-            done_for_now = len(p.replays) > human.max_games
-            self._give_player_long_break(p.name) if done_for_now else self._give_player_short_break(p.name)
+        ids = _player_ids(game.team_1 + game.team_2)
+        breaks = self._breaks_after_game(ids)
+        self._games_played[ids] += 1
+        self._give_breaks(ids, breaks)
 
-    def _give_player_short_break(self, player_name: str):
-        break_until_next_game = int(numpy.abs(numpy.random.normal(0, 8 * 60)))
-        self._give_player_a_break(player_name, break_until_next_game)
+    def _breaks_after_game(self, ids: numpy.ndarray) -> numpy.ndarray:
+        done_for_now = self._games_played[ids] > self._max_games[ids]
+        return numpy.where(done_for_now, self._long_breaks(len(ids)), self._short_breaks(len(ids)))
 
-    def _give_player_long_break(self, player_name: str):
-        break_until_next_game = random.randint(60, 240) * 60
-        self._give_player_a_break(player_name, break_until_next_game)
+    def _short_breaks(self, n: int) -> numpy.ndarray:
+        return numpy.abs(self._normals.take(n) * 8 * 60).astype(int)
+
+    def _long_breaks(self, n: int) -> numpy.ndarray:
+        return (60 + (self._uniforms.take(n) * 181).astype(int)) * 60
 
     def new_game(self, team_1: List[Player], team_2: List[Player]) -> Game:
-        diff = self.avg_skill_diff(team_1, team_2)
-        rnd = numpy.random.normal(0, 300)
-        if rnd < diff:
-            win_ind = 1
-        else:
-            win_ind = 0
-        easy_win = numpy.abs(diff - rnd)
-        game_length = abs(int(numpy.random.normal(20, 2)) - int(easy_win/70)) * 60
-        debug("New game [" + str(game_length) + "]")
-        return Game(game_length, team_1, team_2, win_ind)
+        return self.new_games([Lobby(team_1, team_2)])[0]
+
+    def new_games(self, lobbies: List[Lobby]) -> List[Game]:
+        if len(lobbies) == 0:
+            return []
+        ids_1 = numpy.array([_player_ids(l.team_1) for l in lobbies])
+        ids_2 = numpy.array([_player_ids(l.team_2) for l in lobbies])
+        self._state[ids_1] = PLAYING
+        self._state[ids_2] = PLAYING
+        diffs = self._skill[ids_2].mean(axis=1) - self._skill[ids_1].mean(axis=1)
+        outcome_noise, length_noise = self._game_noise(len(lobbies))
+        rnd = outcome_noise * 300
+        win_inds = (rnd < diffs).astype(int)
+        easy_wins = numpy.abs(diffs - rnd)
+        base_lengths = (20 + length_noise * 2).astype(int)
+        game_lengths = numpy.abs(base_lengths - (easy_wins / 70).astype(int)) * 60
+        games = []
+        for l, game_length, win_ind in zip(lobbies, game_lengths.tolist(), win_inds.tolist()):
+            debug("New game [" + str(game_length) + "]")
+            games.append(Game(game_length, l.team_1, l.team_2, win_ind))
+        return games
+
+    def _game_noise(self, n: int) -> (numpy.ndarray, numpy.ndarray):
+        # standard normal noise of the outcome and of the length of n new games
+        outcome_noise = self._normals.take(n)
+        return outcome_noise, self._normals.take(n)
 
     def player_happiness(self, player: Player) -> float:
+        # computed from the replays, which aren't kept with DataStore(keep_replays=False)
+        if len(player.replays) < self._games_played[_player_id(player.name)]:
+            raise Exception("Replays of " + player.name + " are not kept, happiness is unknown")
         return sum([AdvancedEnvironment._match_happiness(player, r) for r in player.replays])
 
     @staticmethod
@@ -90,46 +153,51 @@ class AdvancedEnvironment(Environment):
             return 100 * (1 - unfairness)
         return - 100 * unfairness
 
-    def _create_human(self):
-        max_games = random.randint(1,5)
-        max_time_queue = random.randint(120, 1200)
-        name = "p-" + str(self._human_index)
-        self._human_index += 1
-        skill = int(numpy.random.normal(2200, 600))
-        return Human(max_games, max_time_queue, name, skill)
-
     def avg_skill_diff(self, team_1: List[Player], team_2: List[Player]):
-        h_1 = [self._humans[p.name] for p in team_1]
-        h_2 = [self._humans[p.name] for p in team_2]
-        return avg([h.skill for h in h_2]) - avg([h.skill for h in h_1])
+        return self._skill[_player_ids(team_2)].mean() - self._skill[_player_ids(team_1)].mean()
+
 
+class _RandomBlock:
+    """Hands out random numbers from blocks drawn with a single call to the given numpy.random function."""
 
-class InactivePlayer:
-    def __init__(self, player_name: str, time_until_play):
-        self.player_name = player_name
-        self.time_until_play = time_until_play
+    def __init__(self, draw: str, block_size: int):
+        self._draw = draw
+        self._block_size = block_size
+        self._block = numpy.empty(0)
+        self._pos = 0
 
-    def __repr__(self):
-        return self.player.__repr__() + "[" + str(self.time_until_play) + "]"
+    def take(self, n: int) -> numpy.ndarray:
+        if self._pos + n > len(self._block):
+            rest = self._block[self._pos:]
+            self._block = numpy.concatenate((rest, getattr(numpy.random, self._draw)(max(n, self._block_size))))
+            self._pos = 0
+        taken = self._block[self._pos: self._pos + n]
+        self._pos += n
+        return taken
 
 
-class Human:
-    def __init__(self, max_games: int, max_time_queue: int, name: str, skill: int):
-        self.max_games = max_games
-        self.max_time_queue = max_time_queue
-        self.name = name
-        self.skill = skill
+def _not_registered(_):
+    pass
 
 
-def max_skill_diff(team_1: List[Human], team_2: List[Human]):
-    return abs(min([h.skill for h in team_1 + team_2]) - max([h.skill for h in team_1 + team_2]))
+def _player_name(player_id: int) -> str:
+    return "p-" + str(player_id + 1)
+
+
+def _player_id(player_name: str) -> int:
+    return int(player_name[2:]) - 1
+
+
+def _player_ids(players: List[Player]) -> numpy.ndarray:
+    return numpy.array([_player_id(p.name) for p in players])
 
 
 class SimpleEnvironment(Environment):
 
-    def __init__(self):
-        self._add_to_queue = lambda x: None
-        self._remove_from_queue = lambda x: None
+    def __init__(self, num_players: int = 100):
+        self._num_players = num_players
+        self._add_to_queue = _not_registered
+        self._remove_from_queue = _not_registered
         self.round = 0
         self._skills = dict()
 
@@ -151,10 +219,13 @@ class SimpleEnvironment(Environment):
     def player_happiness(self, player: Player) -> float:
         pass
 
+    def next_event_in(self) -> Optional[int]:
+        return 1 if self.round == 0 else None
+
     def one_round(self) -> None:
         self.round += 1
         if self.round == 1:
-            for i in range(100):
+            for i in range(self._num_players):
                 name = "p-" + str(i+1)
                 skill = int(numpy.random.normal(2200, 200))
                 self._skills[name] = skill
@@ -0,0 +1,175 @@
+import cProfile
+import json
+import pstats
+import sys
+from collections import Counter, defaultdict, deque
+from time import perf_counter
+from typing import Dict
+
+from core.common import Histogram
+from core.engine import Engine, SKETCH_PRECISION
+
+# engine methods timed per phase; phases nest ("tick" covers everything, "games" covers "mmr_engine" etc.)
+ENGINE_PHASES = {
+    "one_round": "tick",
+    "_skip_idle_rounds": "idle_skip",
+    "_find_lobbies_and_start_games": "matchmaking",
+    "_progress_games": "games",
+}
+
+# collaborator methods timed per phase
+MATCH_MAKER_PHASES = {"find_lobbies": "matchmaker", "find_lobbies_within": "matchmaker"}
+ENVIRONMENT_PHASES = {"one_round": "environment", "skip_rounds": "environment", "new_games": "environment",
+                      "on_game_finished": "environment"}
+MMR_ENGINE_PHASES = {"on_game_finished": "mmr_engine", "on_games_finished": "mmr_engine"}
+
+
+class Instrumentation:
+    """
+    Per-phase timings and latency sketches (in microseconds), and counters for an Engine. attach() swaps timed
+    wrappers in for the engine's phase methods and collaborators, and detach() restores them, so an
+    engine without instrumentation runs exactly the code it did before.
+    """
+
+    def __init__(self, history: int = 1000, dump_every: int = None, dump_path: str = None):
+        self.cumulative = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.ticks = deque(maxlen=history)
+        self.latencies_us = defaultdict(lambda: Histogram(1, SKETCH_PRECISION))
+        self.queue_length = 0
+        self.max_queue_length = 0
+        self._dump_every = dump_every
+        self._dump_path = dump_path
+        self._current_tick = None
+        self._engine = None
+        self._profiler = None
+        self._profile_rounds_left = 0
+        self._profile_path = None
+
+    def attach(self, engine: Engine) -> 'Instrumentation':
+        if self._engine is not None:
+            raise Exception("Already attached")
+        self._engine = engine
+        for method, phase in ENGINE_PHASES.items():
+            setattr(engine, method, self._timed(getattr(engine, method), phase))
+        engine.one_round = self._tick(engine.one_round)
+        engine._on_found_lobby = self._counted(engine._on_found_lobby, "lobbies_formed")
+        engine._on_game_finished = self._counted(engine._on_game_finished, "games_finished")
+        engine._match_maker = _TimedProxy(engine._match_maker, MATCH_MAKER_PHASES, self)
+        engine._environment = _TimedProxy(engine._environment, ENVIRONMENT_PHASES, self)
+        engine._mmr_engine = _TimedProxy(engine._mmr_engine, MMR_ENGINE_PHASES, self)
+        engine._on_game_finished_listeners = _TimedListeners(engine._on_game_finished_listeners, self)
+        engine._on_lobby_found_listeners = _TimedListeners(engine._on_lobby_found_listeners, self)
+        return self
+
+    def detach(self) -> None:
+        engine = self._engine
+        for method in list(ENGINE_PHASES) + ["_on_found_lobby", "_on_game_finished"]:
+            del engine.__dict__[method]
+        engine._match_maker = engine._match_maker.target
+        engine._environment = engine._environment.target
+        engine._mmr_engine = engine._mmr_engine.target
+        engine._on_game_finished_listeners = list(engine._on_game_finished_listeners)
+        engine._on_lobby_found_listeners = list(engine._on_lobby_found_listeners)
+        self._engine = None
+
+    def profile(self, num_rounds: int, path: str = None) -> None:
+        """Run cProfile over the next num_rounds rounds; the stats go to `path`, or are printed."""
+        self._profile_rounds_left = num_rounds
+        self._profile_path = path
+
+    def snapshot(self) -> Dict:
+        num_ticks = self.calls["tick"]
+        return {
+            "ticks": num_ticks,
+            "cumulative_s": dict(self.cumulative),
+            "mean_per_tick_s": {k: v / num_ticks for k, v in self.cumulative.items()} if num_ticks > 0 else {},
+            "last_tick_s": dict(self.ticks[-1]) if len(self.ticks) > 0 else {},
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+            "queue_length": {"last": self.queue_length, "max": self.max_queue_length},
+            "latency_us": {phase: histogram.percentiles() for phase, histogram in self.latencies_us.items()},
+            "matchmaking_budget": self._engine.budget_metrics.summary()
+            if self._engine is not None and self._engine.budget_metrics is not None else None,
+        }
+
+    def dump(self, path: str = None) -> None:
+        path = path or self._dump_path
+        if path is None:
+            json.dump(self.snapshot(), sys.stdout, indent=2)
+            print("")
+            return
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def record(self, phase: str, seconds: float) -> None:
+        self.cumulative[phase] += seconds
+        self.calls[phase] += 1
+        if self._current_tick is not None:
+            self._current_tick[phase] += seconds
+        self.latencies_us[phase].add(int(seconds * 1e6))
+
+    def _timed(self, method, phase: str):
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(phase, perf_counter() - start)
+        return timed
+
+    def _counted(self, method, counter: str):
+        def counted(*args, **kwargs):
+            self.counters[counter] += 1
+            return method(*args, **kwargs)
+        return counted
+
+    def _tick(self, one_round):
+        def tick():
+            self._current_tick = defaultdict(float)
+            if self._profile_rounds_left > 0 and self._profiler is None:
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+            one_round()
+            self.ticks.append(self._current_tick)
+            self._current_tick = None
+            self.queue_length = len(self._engine.queue())
+            self.max_queue_length = max(self.max_queue_length, self.queue_length)
+            if self._profiler is not None:
+                self._profile_rounds_left -= 1
+                if self._profile_rounds_left <= 0:
+                    self._finish_profile()
+            if self._dump_every is not None and self.calls["tick"] % self._dump_every == 0:
+                self.dump()
+        return tick
+
+    def _finish_profile(self):
+        self._profiler.disable()
+        if self._profile_path is not None:
+            self._profiler.dump_stats(self._profile_path)
+        else:
+            pstats.Stats(self._profiler).sort_stats("cumulative").print_stats(20)
+        self._profiler = None
+
+
+class _TimedProxy:
+    def __init__(self, target, phases: Dict[str, str], instrumentation: Instrumentation):
+        self.target = target
+        for method, phase in phases.items():
+            if hasattr(target, method):
+                setattr(self, method, instrumentation._timed(getattr(target, method), phase))
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+class _TimedListeners(list):
+    def __init__(self, listeners, instrumentation: Instrumentation):
+        super().__init__(listeners)
+        self._instrumentation = instrumentation
+
+    def __iter__(self):
+        for listener in super().__iter__():
+            yield _TimedProxy(listener, {"on_game_finished": "listeners", "on_lobby_found": "listeners"},
+                              self._instrumentation)
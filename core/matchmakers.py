@@ -2,8 +2,15 @@
 # -------------------------
 
 import random
+from functools import partial
+from heapq import heappush, heappop
+from itertools import islice
+from time import perf_counter
 from typing import Iterable, List
-from core.common import Queuer, Player, max_mmr, min_mmr, Lobby, MatchMaker
+import numpy
+from core.common import Queuer, Player, max_mmr, min_mmr, Lobby, MatchMaker, Queue, queuer_mmr
+from core.mmr_index import MmrIndex
+from core.team_balance import balance_teams
 
 TEAM_SIZE = 5
 
@@ -13,35 +20,270 @@ class CompositeMatchmaker(MatchMaker):
     def __init__(self, find_lobby):
         self._find_lobby = find_lobby
 
-    def find_lobbies(self, queue: List[Queuer], found_lobby_callback) -> None:
+    def find_lobbies(self, queue: Queue, found_lobby_callback) -> None:
         found = self._find_lobby(queue)
         while found is not None:
             t1, t2 = found
             found_lobby_callback(t1, t2)
             found = self._find_lobby(queue)
 
+    def find_lobbies_within(self, queue: Queue, found_lobby_callback, deadline: float) -> bool:
+        # lobbies are found one at a time, so the search stops between two of them; what is left is
+        # simply searched for again in the next call
+        found = self._find_lobby(queue)
+        while found is not None:
+            t1, t2 = found
+            found_lobby_callback(t1, t2)
+            if perf_counter() >= deadline:
+                return False
+            found = self._find_lobby(queue)
+        return True
+
+
+class BalancedMatchmaker(MatchMaker):
+    """Wraps any matchmaker and re-splits each lobby it finds into the two teams with the closest average MMR."""
+
+    def __init__(self, match_maker: MatchMaker):
+        self._match_maker = match_maker
+
+    def find_lobbies(self, queue: Queue, found_lobby_callback) -> None:
+        self._match_maker.find_lobbies(queue, partial(_balanced_callback, found_lobby_callback))
+
+    def find_lobbies_within(self, queue: Queue, found_lobby_callback, deadline: float) -> bool:
+        return self._match_maker.find_lobbies_within(queue, partial(_balanced_callback, found_lobby_callback), deadline)
+
+    def next_search_in(self, queue: Queue):
+        return self._match_maker.next_search_in(queue)
+
+
+def _balanced_callback(found_lobby_callback, t1, t2):
+    found_lobby_callback(*balance_teams([(t1, t2)])[0])
+
+
+class IncrementalMatchmaker(MatchMaker):
+    """
+    Checks windows of 10 consecutive players in the MMR-sorted queue, but only where the queue has
+    changed since the last round (read from the MMR index's journal) or where a previously rejected
+    window reaches the wait at which the lobby filter will accept it. Since a window's longest wait
+    grows by one every round, that unlock round is known when the window is rejected; until then,
+    and as long as its members stay queued next to each other, the window isn't looked at again.
+    With a deadline, the windows not looked at yet are kept and looked at first in the next call.
+    """
+
+    def __init__(self, lobby_filter=None):
+        self.lobby_filter = lobby_filter or WaitDependentMmrDiff()
+        self._by_mmr = None
+        self._locked = []
+        self._num_locked = 0
+        self._pending = []
+        self._round = 0
+
+    def find_lobbies(self, queue: Queue, found_lobby_callback) -> None:
+        self.find_lobbies_within(queue, found_lobby_callback, None)
+
+    def find_lobbies_within(self, queue: Queue, found_lobby_callback, deadline: float) -> bool:
+        by_mmr = mmr_index(queue)
+        if by_mmr is not self._by_mmr:
+            self._watch(by_mmr)
+            # already in MMR order
+            self._pending = list(by_mmr)
+        pending, self._pending = self._pending, []
+        if len(by_mmr) == 0:
+            by_mmr.journal.clear()
+            return True
+        first = by_mmr[0]
+        self._round = first.enqueued_at + first.waited
+        starts = list(self._unlocked_window_starts())
+        while True:
+            if len(by_mmr.journal) * TEAM_SIZE*2 > len(by_mmr):
+                # most windows have changed: looking at all of them in order is cheaper than finding those
+                by_mmr.journal.clear()
+                starts, pending = [], list(by_mmr)
+            starts.extend(self._changed_window_starts())
+            if len(starts) == 0 and len(pending) == 0:
+                return True
+            # lobbies found here change the queue again; the next pass picks those changes up from the journal.
+            # Windows left by an interrupted call come after the new ones, in the order they were in.
+            starts = sorted(set(q for q in starts if q in by_mmr), key=by_mmr.key) + pending
+            pending = []
+            for i, start in enumerate(starts):
+                # at least one window per call, so that the search always progresses
+                if deadline is not None and i > 0 and perf_counter() >= deadline:
+                    self._pending = starts[i:]
+                    return False
+                window = self._window_at(start)
+                if window is not None:
+                    self._try_window(window, found_lobby_callback)
+            starts = []
+
+    def next_search_in(self, queue: Queue):
+        if len(self._pending) > 0:
+            return 1
+        if len(self._locked) == 0:
+            return None
+        return max(1, self._locked[0][0] - self._round)
+
+    def _watch(self, by_mmr: MmrIndex):
+        self._by_mmr = by_mmr
+        self._locked = []
+        self._pending = []
+        by_mmr.journal = []
+
+    def _changed_window_starts(self) -> List[Queuer]:
+        starts = []
+        for key in self._by_mmr.journal:
+            rank = self._by_mmr.rank_of_key(key)
+            starts.extend(self._by_mmr[max(0, rank - TEAM_SIZE*2): rank + 1])
+        self._by_mmr.journal.clear()
+        return starts
+
+    def _unlocked_window_starts(self):
+        while len(self._locked) > 0 and self._locked[0][0] <= self._round:
+            _, _, window = heappop(self._locked)
+            if self._is_intact(window):
+                yield window[0]
+
+    def _is_intact(self, window: List[Queuer]) -> bool:
+        if any(q not in self._by_mmr for q in window):
+            return False
+        return self._by_mmr.rank(window[-1]) - self._by_mmr.rank(window[0]) == len(window) - 1
+
+    def _window_at(self, start: Queuer):
+        if start not in self._by_mmr:
+            return None
+        rank = self._by_mmr.rank(start)
+        if rank + TEAM_SIZE*2 > len(self._by_mmr):
+            return None
+        return self._by_mmr[rank: rank + TEAM_SIZE*2]
+
+    def _try_window(self, window: List[Queuer], found_lobby_callback) -> None:
+        t1, t2 = _split_alternating(window)
+        if self.lobby_filter(t1, t2):
+            found_lobby_callback(t1, t2)
+            return
+        unlock_wait = self.lobby_filter.unlock_wait(window[-1].player.mmr - window[0].player.mmr)
+        if unlock_wait is not None:
+            oldest = min(q.enqueued_at for q in window)
+            heappush(self._locked, (max(oldest + unlock_wait, self._round + 1), self._num_locked, window))
+            self._num_locked += 1
+
+
+class BatchMatchmaker(MatchMaker):
+    """
+    Partitions the whole MMR-sorted queue in one pass per round. Every run of 10 consecutive players
+    that is good enough by the wait-dependent boundary of _is_good_enough is a candidate lobby worth
+    lobby_value + wait_weight * (longest wait) - (MMR spread), but at least MIN_VALUE, so that a good
+    enough lobby is always worth forming (the boundary grows faster than the value with the wait, and
+    the longest waiters would be left over otherwise); dynamic programming over the sorted order picks the set of non-overlapping candidates with the highest total value, and all of them
+    are then handed to the callback. With balance=True, teams of the whole batch are balanced at once.
+
+    With a deadline, the sorted queue is partitioned in chunks, which lobbies don't span, until the
+    deadline; the next call continues after the last chunk partitioned. Chunks are sized to what the
+    previous ones say fits in the remaining time, between MIN_CHUNK and max_chunk_size players.
+    """
+
+    MIN_CHUNK = 100
+    MIN_VALUE = 1e-3
+
+    def __init__(self, lobby_value: float = 1000, wait_weight: float = 1.0, balance: bool = False,
+                 max_chunk_size: int = 5000):
+        self.lobby_value = lobby_value
+        self.wait_weight = wait_weight
+        self.balance = balance
+        self.max_chunk_size = max_chunk_size
+        self._resume_key = None
+        self._seconds_per_player = 0.0
+
+    def find_lobbies(self, queue: Queue, found_lobby_callback) -> None:
+        if len(queue) < TEAM_SIZE * 2:
+            return
+        self._partition(list(mmr_index(queue)), found_lobby_callback)
+
+    def find_lobbies_within(self, queue: Queue, found_lobby_callback, deadline: float) -> bool:
+        by_mmr = mmr_index(queue)
+        start = 0 if self._resume_key is None else by_mmr.rank_of_key(self._resume_key)
+        self._resume_key = None
+        while start < len(by_mmr):
+            chunk = by_mmr[start: start + self._chunk_size(deadline)]
+            last_key = by_mmr.key(chunk[-1])
+            chunk_start = perf_counter()
+            self._partition(chunk, found_lobby_callback)
+            self._seconds_per_player = (perf_counter() - chunk_start) / len(chunk)
+            # the chunk's players that are still queued now end right before rank_of_key(last_key)
+            start = by_mmr.rank_of_key(last_key) + (1 if chunk[-1] in by_mmr else 0)
+            if start < len(by_mmr) and perf_counter() >= deadline:
+                self._resume_key = by_mmr.key(by_mmr[start])
+                return False
+        return True
+
+    def _chunk_size(self, deadline: float) -> int:
+        if self._seconds_per_player <= 0:
+            return self.MIN_CHUNK
+        fits = int((deadline - perf_counter()) / self._seconds_per_player)
+        return min(max(fits, self.MIN_CHUNK), self.max_chunk_size)
+
+    def _partition(self, queuers: List[Queuer], found_lobby_callback) -> None:
+        lobby_size = TEAM_SIZE * 2
+        if len(queuers) < lobby_size:
+            return
+        spreads, max_waits = window_stats(queuers)
+        values = numpy.where(spreads < _wait_mmr_boundaries(max_waits),
+                             numpy.maximum(self.lobby_value + self.wait_weight * max_waits - spreads,
+                                           self.MIN_VALUE), -numpy.inf)
+        lobbies = [_split_alternating(queuers[start: start + lobby_size])
+                   for start in _best_windows(values.tolist(), lobby_size)]
+        if self.balance:
+            lobbies = balance_teams(lobbies)
+        for t1, t2 in lobbies:
+            found_lobby_callback(t1, t2)
+
 
-def find_by_sorted_mmr(queue: List[Queuer]) -> (List[Queuer], List[Queuer]):
+def _best_windows(values: List[float], lobby_size: int) -> List[int]:
+    # best[i]: the highest total value of non-overlapping windows among the first i players
+    best = [0.0] * (len(values) + lobby_size)
+    took = [False] * len(best)
+    for i in range(lobby_size, len(best)):
+        best[i] = best[i - 1]
+        value = values[i - lobby_size]
+        if value > 0 and best[i - lobby_size] + value > best[i]:
+            best[i] = best[i - lobby_size] + value
+            took[i] = True
+    starts = []
+    i = len(best) - 1
+    while i >= lobby_size:
+        if took[i]:
+            starts.append(i - lobby_size)
+            i -= lobby_size
+        else:
+            i -= 1
+    return starts[::-1]
+
+
+def find_by_sorted_mmr(queue: Queue) -> (List[Queuer], List[Queuer]):
     if len(queue) < TEAM_SIZE*2:
         return None
-    copy = sorted_queue(queue)
-    ind = random.randint(0, len(copy) - TEAM_SIZE*2)
-    t1 = []
-    t2 = []
-    for i in range(TEAM_SIZE):
-        t1.append(copy[(ind + 2*i) % len(copy)])
-        t2.append(copy[(ind + 2*i + 1) % len(copy)])
-    return t1, t2
+    by_mmr = mmr_index(queue)
+    ind = random.randint(0, len(by_mmr) - TEAM_SIZE*2)
+    return _split_alternating(by_mmr[ind: ind + TEAM_SIZE*2])
+
+
+def mmr_index(queue) -> MmrIndex:
+    if isinstance(queue, MmrIndex):
+        return queue
+    if isinstance(queue, Queue):
+        return queue.by_mmr
+    index = MmrIndex(queuer_mmr)
+    for queuer in queue:
+        index.add(queuer)
+    return index
 
 
 def sorted_queue(queue):
-    copy = list(queue)
-    copy.sort(key=lambda q: q.player.mmr)
-    return copy
+    return list(mmr_index(queue))
 
 
 def max_mmr_diff(mmr_boundary):
-    return lambda t1, t2: _max_mmr_diff_filter(t1, t2, mmr_boundary)
+    return MaxMmrDiff(mmr_boundary)
 
 
 def _max_mmr_diff_filter(t1, t2, mmr_diff_boundary):
@@ -51,7 +293,59 @@ def _max_mmr_diff_filter(t1, t2, mmr_diff_boundary):
 
 
 def max_mmr_diff_or_long_wait(mmr_diff_boundary, wait_boundary):
-    return lambda t1, t2: _max_mmr_diff_filter(t1, t2, mmr_diff_boundary) or _long_wait_filter(t1, t2, wait_boundary)
+    return MaxMmrDiffOrLongWait(mmr_diff_boundary, wait_boundary)
+
+
+class MaxMmrDiff:
+    """
+    Lobby filter accepting lobbies with an MMR spread below the boundary. Like the other filters it
+    also tells the longest wait at which a lobby with a given spread becomes acceptable (None: never),
+    and judges many windows of sorted players at once from their spreads and longest waits (accepts).
+    """
+
+    def __init__(self, mmr_diff_boundary: int):
+        self.mmr_diff_boundary = mmr_diff_boundary
+
+    def __call__(self, t1, t2) -> bool:
+        return _max_mmr_diff_filter(t1, t2, self.mmr_diff_boundary)
+
+    def accepts(self, spreads: numpy.ndarray, max_waits: numpy.ndarray) -> numpy.ndarray:
+        """__call__ for many windows at once, given their MMR spreads and longest waits."""
+        return spreads < self.mmr_diff_boundary
+
+    def unlock_wait(self, spread: int):
+        return 0 if spread < self.mmr_diff_boundary else None
+
+
+class MaxMmrDiffOrLongWait(MaxMmrDiff):
+
+    def __init__(self, mmr_diff_boundary: int, wait_boundary: int):
+        super().__init__(mmr_diff_boundary)
+        self.wait_boundary = wait_boundary
+
+    def __call__(self, t1, t2) -> bool:
+        return _max_mmr_diff_filter(t1, t2, self.mmr_diff_boundary) or _long_wait_filter(t1, t2, self.wait_boundary)
+
+    def accepts(self, spreads: numpy.ndarray, max_waits: numpy.ndarray) -> numpy.ndarray:
+        return (spreads < self.mmr_diff_boundary) | (max_waits > self.wait_boundary)
+
+    def unlock_wait(self, spread: int):
+        return 0 if spread < self.mmr_diff_boundary else self.wait_boundary + 1
+
+
+class WaitDependentMmrDiff:
+    """The lobby filter of fair_method: the allowed MMR spread grows with the longest wait (see _is_good_enough)."""
+
+    def __call__(self, t1, t2) -> bool:
+        return _is_good_enough(t1, t2)
+
+    def accepts(self, spreads: numpy.ndarray, max_waits: numpy.ndarray) -> numpy.ndarray:
+        return spreads < _wait_mmr_boundaries(max_waits)
+
+    def unlock_wait(self, spread: int):
+        if spread - 99 < 300:
+            return max(0, spread - 99)
+        return max(300, (spread - 100) // 2 + 1)
 
 
 def _long_wait_filter(t1, t2, wait_boundary):
@@ -59,35 +353,193 @@ def _long_wait_filter(t1, t2, wait_boundary):
 
 
 def filtered_find_by_sorted_mmr(num_tries: int, lobby_filter) -> Lobby:
-    return lambda queue: _filtered_find_by_sorted_mmr(queue, num_tries, lobby_filter)
+    return partial(_filtered_find_by_sorted_mmr, num_tries=num_tries, lobby_filter=lobby_filter,
+                   windows=SortedWindows())
 
 
-def fair_method(queue: List[Queuer]) -> (List[Queuer], List[Queuer]):
+def fair_method(queue: Queue) -> (List[Queuer], List[Queuer]):
     if len(queue) < TEAM_SIZE*2:
         return None
-    num_tries = min(100, len(queue))
-    for i in range(num_tries):
-        queuer = queue[i]
+    for queuer in islice(queue, 100):
         found = find_lobby_for(queuer, queue)
         if found is not None:
             return found
     return None
 
 
-def find_lobby_for(queuer: Queuer, queue: List[Queuer]) -> (List[Queuer], List[Queuer]):
-    sorted_by_mmr = sorted_queue(queue)
-    ind = index_of(queuer, sorted_by_mmr)
-    pick_right = len(queue) - ind
+def find_lobby_for(queuer: Queuer, queue: Queue) -> (List[Queuer], List[Queuer]):
+    by_mmr = mmr_index(queue)
+    ind = by_mmr.rank(queuer)
+    pick_right = len(by_mmr) - ind
     if pick_right >= TEAM_SIZE*2:
-        picked = sorted_by_mmr[ind: ind+TEAM_SIZE*2]
+        picked = by_mmr[ind: ind+TEAM_SIZE*2]
     else:
         pick_left = TEAM_SIZE*2 - pick_right
-        picked = sorted_by_mmr[ind - pick_left: ind + pick_right]
+        picked = by_mmr[ind - pick_left: ind + pick_right]
+    t1, t2 = _split_alternating(picked)
+    return (t1, t2) if _is_good_enough(t1, t2) else None
+
+
+def window_stats(queuers: List[Queuer]) -> (numpy.ndarray, numpy.ndarray):
+    """
+    MMR spread and longest wait of every window of 10 consecutive players in an MMR-sorted list,
+    indexed by the window's first player.
+    """
+    mmrs = numpy.fromiter((q.player.mmr for q in queuers), dtype=float, count=len(queuers))
+    waits = numpy.fromiter((q.waited for q in queuers), dtype=float, count=len(queuers))
+    return _window_stats(mmrs, waits)
+
+
+def _window_stats(mmrs: numpy.ndarray, waits: numpy.ndarray) -> (numpy.ndarray, numpy.ndarray):
+    lobby_size = TEAM_SIZE * 2
+    if len(mmrs) < lobby_size:
+        return numpy.zeros(0), numpy.zeros(0)
+    num_windows = len(mmrs) - lobby_size + 1
+    spreads = mmrs[lobby_size - 1:] - mmrs[:num_windows]
+    max_waits = waits[:num_windows].copy()
+    for i in range(1, lobby_size):
+        numpy.maximum(max_waits, waits[i: i + num_windows], out=max_waits)
+    return spreads, max_waits
+
+
+def acceptable_windows(queuers: List[Queuer], lobby_filter) -> numpy.ndarray:
+    """Starts of the windows of window_stats that the lobby filter accepts, by its array predicate."""
+    return numpy.flatnonzero(lobby_filter.accepts(*window_stats(queuers)))
+
+
+class SortedWindows:
+    """
+    Spreads and longest waits of all windows of the MMR-sorted queue. The queue is read once, then the
+    windows are kept in sync with it: a lobby taken with take(), or the changes listed in the MMR
+    index's journal, only cost a few array edits and one vectorized pass over the windows. Players are
+    kept by the round they were enqueued at, so the windows stay valid from one round to the next.
+    """
+
+    def __init__(self):
+        self._by_mmr = None
+        self._journal = None
+        self._reset()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_by_mmr=None, _journal=None, _version=None, queuers=numpy.zeros(0, dtype=object))
+        return state
+
+    def _reset(self):
+        # version of the watched queue the windows are up to date for
+        self._version = None
+        # the queuers in MMR order, with the (mmr, insertion number) keys they are indexed under
+        self.queuers = numpy.zeros(0, dtype=object)
+        self.mmrs = numpy.zeros(0)
+        self.seqs = numpy.zeros(0, dtype=numpy.int64)
+        self.enqueued = numpy.zeros(0)
+        self.spreads = numpy.zeros(0)
+        # earliest enqueue round in each window
+        self.first_enqueued = numpy.zeros(0)
+
+    def stats(self, queue) -> (numpy.ndarray, numpy.ndarray):
+        by_mmr = mmr_index(queue)
+        if not isinstance(queue, Queue) or by_mmr is not self._by_mmr or by_mmr.journal is not self._journal:
+            self._watch(queue, by_mmr)
+        elif self._version != queue.version:
+            self._sync(queue, by_mmr)
+        if isinstance(queue, Queue):
+            self._version = queue.version
+        if len(by_mmr) == 0:
+            return self.spreads, self.first_enqueued
+        first = by_mmr[0]
+        return self.spreads, first.enqueued_at + first.waited - self.first_enqueued
+
+    def take(self, queue, start: int) -> List[Queuer]:
+        """The window at start; the queue is expected to lose exactly these players in one removal."""
+        lobby_size = TEAM_SIZE * 2
+        stop = start + lobby_size
+        window = self.queuers[start: stop].tolist()
+        self.queuers, self.mmrs, self.seqs, self.enqueued = (
+            numpy.concatenate((a[:start], a[stop:])) for a in (self.queuers, self.mmrs, self.seqs, self.enqueued))
+        # the windows that overlapped the lobby are replaced by the ones now spanning the gap (at most 9)
+        first = max(0, start - lobby_size + 1)
+        mmrs, enqueued = self.mmrs[first: stop - 1].tolist(), self.enqueued[first: stop - 1].tolist()
+        spreads = [mmrs[i + lobby_size - 1] - mmrs[i] for i in range(len(mmrs) - lobby_size + 1)]
+        first_enqueued = [min(enqueued[i: i + lobby_size]) for i in range(len(enqueued) - lobby_size + 1)]
+        self.spreads = numpy.concatenate((self.spreads[:first], spreads, self.spreads[stop:]))
+        self.first_enqueued = numpy.concatenate((self.first_enqueued[:first], first_enqueued,
+                                                 self.first_enqueued[stop:]))
+        if self._version is not None and self._version == getattr(queue, "version", None):
+            self._version += 1
+        return window
+
+    def _watch(self, queue, by_mmr: MmrIndex):
+        if self._by_mmr is not None and self._by_mmr.journal is self._journal:
+            self._by_mmr.journal = None
+        self._by_mmr, self._journal = None, None
+        if isinstance(queue, Queue):
+            # the index of a Queue stays the same, so its changes can be followed from here on
+            self._by_mmr = by_mmr
+            self._journal = by_mmr.journal = []
+        self._reset()
+        keys = by_mmr.keys()
+        self.queuers = numpy.array([by_mmr.item(key) for key in keys], dtype=object)
+        self.mmrs = numpy.fromiter((key[0] for key in keys), dtype=float, count=len(keys))
+        self.seqs = numpy.fromiter((key[1] for key in keys), dtype=numpy.int64, count=len(keys))
+        self.enqueued = numpy.fromiter((q.enqueued_at for q in self.queuers), dtype=float, count=len(keys))
+        self._update_windows()
+
+    def _sync(self, queue: Queue, by_mmr: MmrIndex):
+        changed = list(set(self._journal))
+        self._journal.clear()
+        if len(changed) == 0:
+            return
+        if len(changed) * 4 > len(self.queuers):
+            # reading the whole queue again is cheaper than that many edits
+            self._watch(queue, by_mmr)
+            return
+        mmrs = numpy.array([key[0] for key in changed], dtype=float)
+        seqs = numpy.array([key[1] for key in changed], dtype=numpy.int64)
+        positions = self._positions(mmrs, seqs)
+        indexed = [by_mmr.item(key) for key in changed]
+        nearest = numpy.minimum(positions, len(self.seqs) - 1)
+        cached = (positions < len(self.seqs)) & (self.mmrs[nearest] == mmrs) & (self.seqs[nearest] == seqs)
+        # lobbies taken with take() are listed too, but are neither cached nor indexed any more
+        removed = [p for p, c, q in zip(positions.tolist(), cached.tolist(), indexed) if c and q is None]
+        added = [i for i, (c, q) in enumerate(zip(cached.tolist(), indexed)) if not c and q is not None]
+        self.queuers, self.mmrs, self.seqs, self.enqueued = (
+            numpy.delete(a, removed) for a in (self.queuers, self.mmrs, self.seqs, self.enqueued))
+        if len(added) > 0:
+            order = numpy.lexsort((seqs[added], mmrs[added]))
+            added = [added[i] for i in order.tolist()]
+            queuers = numpy.array([indexed[i] for i in added], dtype=object)
+            positions = self._positions(mmrs[added], seqs[added])
+            self.queuers = numpy.insert(self.queuers, positions, queuers)
+            self.mmrs = numpy.insert(self.mmrs, positions, mmrs[added])
+            self.seqs = numpy.insert(self.seqs, positions, seqs[added])
+            self.enqueued = numpy.insert(self.enqueued, positions, [q.enqueued_at for q in queuers.tolist()])
+        self._update_windows()
+
+    def _positions(self, mmrs: numpy.ndarray, seqs: numpy.ndarray) -> numpy.ndarray:
+        # where the (mmr, insertion number) keys are, or would be inserted, all at once: within one MMR
+        # the insertion numbers ascend, so numbering the distinct MMRs gives one ascending integer key
+        if len(self.mmrs) == 0:
+            return numpy.zeros(len(mmrs), dtype=int)
+        groups = numpy.concatenate(([0], numpy.cumsum(self.mmrs[1:] != self.mmrs[:-1])))
+        span = int(max(self.seqs.max(), seqs.max())) + 1
+        starts = numpy.searchsorted(self.mmrs, mmrs)
+        nearest = numpy.minimum(starts, len(self.mmrs) - 1)
+        in_group = (starts < len(self.mmrs)) & (self.mmrs[nearest] == mmrs)
+        combined = groups * span + self.seqs
+        return numpy.where(in_group, numpy.searchsorted(combined, groups[nearest] * span + seqs), starts)
+
+    def _update_windows(self):
+        self.spreads, first_enqueued = _window_stats(self.mmrs, -self.enqueued)
+        self.first_enqueued = -first_enqueued
+
+
+def _split_alternating(picked: List[Queuer]) -> (List[Queuer], List[Queuer]):
     t1, t2 = [], []
     for i in range(TEAM_SIZE):
         t1.append(picked[2*i])
         t2.append(picked[2*i+1])
-    return (t1, t2) if _is_good_enough(t1, t2) else None
+    return t1, t2
 
 
 def _is_good_enough(t1, t2):
@@ -98,17 +550,21 @@ def _is_good_enough(t1, t2):
     return _max_mmr_diff_filter(t1, t2, mmr_boundary)
 
 
-def _max_wait(t1, t2):
-    return max(q.waited for q in t1 + t2)
+def _wait_mmr_boundaries(max_waits: numpy.ndarray) -> numpy.ndarray:
+    # the same MMR boundary as _is_good_enough, for an array of max wait times
+    return 100 + max_waits * numpy.where(max_waits < 300, 1, 2)
 
 
-def index_of(el, arr):
-    return [i for i, x in enumerate(arr) if x == el][0]
+def _max_wait(t1, t2):
+    return max(q.waited for q in t1 + t2)
 
 
-def _filtered_find_by_sorted_mmr(queue: List[Queuer], num_tries: int, lobby_filter) -> Lobby:
+def _filtered_find_by_sorted_mmr(queue: List[Queuer], num_tries: int, lobby_filter,
+                                 windows: SortedWindows = None) -> Lobby:
     if len(queue) < TEAM_SIZE*2:
         return None
+    if windows is not None and hasattr(lobby_filter, "accepts"):
+        return _vectorized_find_by_sorted_mmr(queue, num_tries, lobby_filter, windows)
     for i in range(num_tries):
         t1, t2 = find_by_sorted_mmr(queue)
         valid_lobby = lobby_filter(t1, t2)
@@ -117,6 +573,16 @@ def _filtered_find_by_sorted_mmr(queue: List[Queuer], num_tries: int, lobby_filt
     return None
 
 
+def _vectorized_find_by_sorted_mmr(queue: List[Queuer], num_tries: int, lobby_filter, windows: SortedWindows) -> Lobby:
+    # the same random tries as above, but every window is judged at once by the filter's array predicate
+    accepted = lobby_filter.accepts(*windows.stats(queue))
+    for i in range(num_tries):
+        ind = random.randint(0, len(accepted) - 1)
+        if accepted[ind]:
+            return _split_alternating(windows.take(queue, ind))
+    return None
+
+
 def _get_random_slice(array: Iterable, slice_size: int) -> list:
     copy = list(array)
     random.shuffle(copy)
@@ -148,3 +614,7 @@ simple_matchmaker = CompositeMatchmaker(find_by_sorted_mmr)
 advanced_matchmaker = CompositeMatchmaker(filtered_find_by_sorted_mmr(50, max_mmr_diff(300)))
 advanced_matchmaker2 = CompositeMatchmaker(filtered_find_by_sorted_mmr(50, max_mmr_diff_or_long_wait(300, 60*5)))
 fair_matchmaker = CompositeMatchmaker(fair_method)
+batch_matchmaker = BatchMatchmaker()
+balanced_fair_matchmaker = BalancedMatchmaker(fair_matchmaker)
+balanced_batch_matchmaker = BatchMatchmaker(balance=True)
+incremental_matchmaker = IncrementalMatchmaker()
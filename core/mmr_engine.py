@@ -1,5 +1,10 @@
+from typing import List, Tuple
+import numpy
 from core.common import MmrEngine, Game, Environment
 
+# Glicko's scale factor, ln(10) / 400
+Q = numpy.log(10) / 400
+
 
 class BaseMmrEngine(MmrEngine):
 
@@ -25,4 +30,82 @@ class CheatingMmrEngine(MmrEngine):
 
     # cheating by using players' actual skill-level as their MMR
     def initial_mmr(self, player_name: str):
-        return self._environment.get_player_skill(player_name)
\ No newline at end of file
+        return self._environment.get_player_skill(player_name)
+
+
+class GlickoMmrEngine(MmrEngine):
+    """
+    Glicko-style team ratings: every player has a rating and a rating deviation (uncertainty), kept in
+    arrays indexed by player id. All games finishing in a round are rated in one NumPy pass, with each
+    team playing as one opponent whose rating and deviation are its players' mean and RMS. The ratings
+    are written back to Player.mmr. Deviations shrink with every game down to min_deviation, so ratings
+    of new players move quickly and settled ones keep adapting a little.
+    """
+
+    def __init__(self, initial_rating: int = 2200, initial_deviation: float = 350, min_deviation: float = 50):
+        self.initial_rating = initial_rating
+        self.initial_deviation = initial_deviation
+        self.min_deviation = min_deviation
+        self.ratings = numpy.zeros(0)
+        self.deviations = numpy.zeros(0)
+        self._rated = numpy.zeros(0, dtype=bool)
+
+    def initial_mmr(self, player_name: str):
+        return self.initial_rating
+
+    def on_game_finished(self, game: Game):
+        self.on_games_finished([game])
+
+    def on_games_finished(self, games: List[Game]) -> None:
+        team_1 = [p for g in games for p in g.team_1]
+        team_2 = [p for g in games for p in g.team_2]
+        ids_1 = self._ids(team_1).reshape(len(games), -1)
+        ids_2 = self._ids(team_2).reshape(len(games), -1)
+        winners = numpy.array([g.winner_index for g in games])
+        ratings, deviations = glicko_update((self.ratings[ids_1], self.ratings[ids_2]),
+                                           (self.deviations[ids_1], self.deviations[ids_2]), winners)
+        ids = numpy.concatenate((ids_1.ravel(), ids_2.ravel()))
+        self.ratings[ids] = numpy.concatenate([r.ravel() for r in ratings])
+        self.deviations[ids] = numpy.maximum(numpy.concatenate([d.ravel() for d in deviations]), self.min_deviation)
+        for p, rating in zip(team_1 + team_2, self.ratings[ids].round().astype(int).tolist()):
+            p.mmr = rating
+
+    def _ids(self, players) -> numpy.ndarray:
+        ids = numpy.array([p.id for p in players], dtype=int)
+        if len(ids) > 0 and ids.max() >= len(self.ratings):
+            self._grow(ids.max() + 1)
+        # a player's first rating is the MMR it was given, e.g. by initial_mmr()
+        new = ids[~self._rated[ids]]
+        if len(new) > 0:
+            mmr_of = {p.id: p.mmr for p in players}
+            self.ratings[new] = [mmr_of[i] for i in new.tolist()]
+            self.deviations[new] = self.initial_deviation
+            self._rated[new] = True
+        return ids
+
+    def _grow(self, size: int):
+        size = max(size, 2 * len(self.ratings))
+        self.ratings = numpy.resize(self.ratings, size)
+        self.deviations = numpy.resize(self.deviations, size)
+        self._rated = numpy.concatenate((self._rated, numpy.zeros(size - len(self._rated), dtype=bool)))
+
+
+def glicko_update(ratings: Tuple[numpy.ndarray, numpy.ndarray], deviations: Tuple[numpy.ndarray, numpy.ndarray],
+                  winner_indices: numpy.ndarray) -> Tuple[Tuple, Tuple]:
+    """
+    One Glicko rating period for a batch of team games. Ratings and deviations are given per team as
+    (games x team size) arrays; returns the updated ones in the same form.
+    """
+    team_ratings = [r.mean(axis=1) for r in ratings]
+    team_deviations = [numpy.sqrt((d ** 2).mean(axis=1)) for d in deviations]
+    new_ratings, new_deviations = [], []
+    for team in (0, 1):
+        opponent_rating, opponent_deviation = team_ratings[1 - team], team_deviations[1 - team]
+        g = 1 / numpy.sqrt(1 + 3 * Q ** 2 * opponent_deviation ** 2 / numpy.pi ** 2)
+        expected = 1 / (1 + 10 ** (-g * (team_ratings[team] - opponent_rating) / 400))
+        score = (winner_indices == team).astype(float)
+        d_squared = 1 / (Q ** 2 * g ** 2 * expected * (1 - expected))
+        precision = 1 / deviations[team] ** 2 + (1 / d_squared)[:, None]
+        new_ratings.append(ratings[team] + Q / precision * (g * (score - expected))[:, None])
+        new_deviations.append(numpy.sqrt(1 / precision))
+    return tuple(new_ratings), tuple(new_deviations)
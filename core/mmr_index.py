@@ -0,0 +1,176 @@
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate
+from typing import Any, Callable, Iterator, List
+
+
+class MmrIndex:
+    """
+    Keeps items ordered by MMR (ties broken by insertion order) in a list of sorted buckets.
+    Lookups bisect over the bucket maxima, so insert/remove/rank cost O(log n) plus a small
+    constant bucket shift, instead of re-sorting the whole collection.
+    """
+
+    def __init__(self, mmr_of: Callable[[Any], int], load: int = 256):
+        self._mmr_of = mmr_of
+        self._load = load
+        self._buckets = []
+        self._maxes = []
+        self._offsets = None
+        self._keys = dict()
+        self._items = dict()
+        self._num_added = 0
+        # when set to a list, keys of added and removed items are appended to it
+        self.journal = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, item):
+        return item in self._keys
+
+    def __iter__(self) -> Iterator[Any]:
+        for bucket in self._buckets:
+            for key in bucket:
+                yield self._items[key]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise Exception("Bad argument: " + str(index))
+            return self._slice(start, stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        pos = self._bucket_at(index)
+        return self._items[self._buckets[pos][index - self._offsets[pos]]]
+
+    def add(self, item) -> None:
+        if item in self._keys:
+            raise Exception("Already indexed: " + str(item))
+        self._insert_key(item, (self._mmr_of(item), self._num_added))
+        self._num_added += 1
+
+    def remove(self, item) -> None:
+        key = self._keys.pop(item)
+        del self._items[key]
+        if self.journal is not None:
+            self.journal.append(key)
+        pos = self._bucket_of(key)
+        bucket = self._buckets[pos]
+        del bucket[bisect_left(bucket, key)]
+        if len(bucket) == 0:
+            del self._buckets[pos]
+            del self._maxes[pos]
+        else:
+            self._maxes[pos] = bucket[-1]
+        self._offsets = None
+
+    def remove_many(self, items) -> None:
+        keys = [self._keys.pop(item) for item in items]
+        for key in keys:
+            del self._items[key]
+        if self.journal is not None:
+            self.journal.extend(keys)
+        by_bucket = dict()
+        for key in keys:
+            by_bucket.setdefault(self._bucket_of(key), set()).add(key)
+        # from the last bucket down, so that dropping an emptied bucket doesn't move the ones still to do
+        for pos in sorted(by_bucket, reverse=True):
+            bucket = [k for k in self._buckets[pos] if k not in by_bucket[pos]]
+            if len(bucket) == 0:
+                del self._buckets[pos]
+                del self._maxes[pos]
+            else:
+                self._buckets[pos] = bucket
+                self._maxes[pos] = bucket[-1]
+        self._offsets = None
+
+    def update(self, item) -> None:
+        """Re-position an item whose MMR has changed since it was indexed."""
+        mmr, seq = self._keys[item]
+        new_mmr = self._mmr_of(item)
+        if new_mmr != mmr:
+            self.remove(item)
+            self._insert_key(item, (new_mmr, seq))
+
+    def rank(self, item) -> int:
+        key = self._keys[item]
+        pos = self._bucket_of(key)
+        self._ensure_offsets()
+        return self._offsets[pos] + bisect_left(self._buckets[pos], key)
+
+    def mmr(self, item) -> int:
+        return self._keys[item][0]
+
+    def key(self, item):
+        return self._keys[item]
+
+    def keys(self) -> List[Any]:
+        """The (mmr, insertion number) keys of all items, in order."""
+        return [key for bucket in self._buckets for key in bucket]
+
+    def item(self, key):
+        """The item currently indexed under the given key, or None."""
+        return self._items.get(key)
+
+    def rank_of_mmr(self, mmr: int) -> int:
+        """Rank of the first item with an MMR of at least the given value."""
+        return self.rank_of_key((mmr,))
+
+    def rank_of_key(self, key) -> int:
+        """Rank at which an item with the given (mmr, insertion number) key is, or would be, indexed."""
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._buckets):
+            return len(self)
+        self._ensure_offsets()
+        return self._offsets[pos] + bisect_left(self._buckets[pos], key)
+
+    def between(self, min_mmr: int, max_mmr: int) -> List[Any]:
+        return self[self.rank_of_mmr(min_mmr): self.rank_of_mmr(max_mmr + 1)]
+
+    def _insert_key(self, item, key):
+        self._keys[item] = key
+        self._items[key] = item
+        if self.journal is not None:
+            self.journal.append(key)
+        self._offsets = None
+        if len(self._buckets) == 0:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+        pos = min(bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[pos]
+        insort(bucket, key)
+        self._maxes[pos] = bucket[-1]
+        if len(bucket) > 2 * self._load:
+            self._buckets.insert(pos + 1, bucket[self._load:])
+            del bucket[self._load:]
+            self._maxes.insert(pos, bucket[-1])
+
+    def _bucket_of(self, key) -> int:
+        return bisect_left(self._maxes, key)
+
+    def _bucket_at(self, index: int) -> int:
+        self._ensure_offsets()
+        return bisect_right(self._offsets, index) - 1
+
+    def _ensure_offsets(self):
+        if self._offsets is None:
+            self._offsets = [0] + list(accumulate(len(b) for b in self._buckets))[:-1]
+
+    def _slice(self, start: int, stop: int) -> List[Any]:
+        if start >= stop:
+            return []
+        pos = self._bucket_at(start)
+        i = start - self._offsets[pos]
+        picked = []
+        remaining = stop - start
+        while remaining > 0:
+            keys = self._buckets[pos][i: i + remaining]
+            picked.extend(self._items[k] for k in keys)
+            remaining -= len(keys)
+            pos += 1
+            i = 0
+        return picked
@@ -0,0 +1,187 @@
+import itertools
+from typing import Dict, List, Sequence, Tuple
+
+import numpy
+
+from core.common import Environment, Replay
+from core.engine import Engine
+from core.mmr_engine import glicko_update
+from core.replay_store import ReplayReader
+
+
+class FixedStepRating:
+    """What BaseMmrEngine does: winners gain and losers lose a fixed step."""
+
+    def __init__(self, step: int = 100):
+        self.step = step
+
+    def start(self, ratings: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+        return {"ratings": ratings}
+
+    def update(self, state, ids_1: numpy.ndarray, ids_2: numpy.ndarray, winners: numpy.ndarray) -> None:
+        sign = numpy.where(winners == 0, 1, -1)[:, None]
+        state["ratings"][ids_1] += self.step * sign
+        state["ratings"][ids_2] -= self.step * sign
+
+
+class EloRating:
+    """Team Elo: each player moves by k times the surprise of the game, from the teams' mean ratings."""
+
+    def __init__(self, k: float = 32):
+        self.k = k
+
+    def start(self, ratings: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+        return {"ratings": ratings}
+
+    def update(self, state, ids_1: numpy.ndarray, ids_2: numpy.ndarray, winners: numpy.ndarray) -> None:
+        ratings = state["ratings"]
+        expected = 1 / (1 + 10 ** ((ratings[ids_2].mean(axis=1) - ratings[ids_1].mean(axis=1)) / 400))
+        change = (self.k * ((winners == 0) - expected))[:, None]
+        ratings[ids_1] += change
+        ratings[ids_2] -= change
+
+
+class GlickoRating:
+    """The update of GlickoMmrEngine."""
+
+    def __init__(self, initial_deviation: float = 350, min_deviation: float = 50):
+        self.initial_deviation = initial_deviation
+        self.min_deviation = min_deviation
+
+    def start(self, ratings: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+        return {"ratings": ratings, "deviations": numpy.full(len(ratings), float(self.initial_deviation))}
+
+    def update(self, state, ids_1: numpy.ndarray, ids_2: numpy.ndarray, winners: numpy.ndarray) -> None:
+        ratings, deviations = state["ratings"], state["deviations"]
+        (r_1, r_2), (d_1, d_2) = glicko_update((ratings[ids_1], ratings[ids_2]),
+                                               (deviations[ids_1], deviations[ids_2]), winners)
+        ratings[ids_1], ratings[ids_2] = r_1, r_2
+        deviations[ids_1] = numpy.maximum(d_1, self.min_deviation)
+        deviations[ids_2] = numpy.maximum(d_2, self.min_deviation)
+
+
+class Recalibration:
+    """
+    Recomputes ratings from a replay history with any of the rating algorithms above, without running
+    the environment or a matchmaker again. The games are split once into levels: a game's level is one
+    more than the highest level of the earlier games of its players. Games of one level share no
+    players and only depend on lower levels, so each level is rated in one NumPy pass and the result is
+    the same as rating the games one by one. The levels are reused for every algorithm that is tried.
+
+    skills (optional, by player id) are the ground truth that ratings are compared to.
+    """
+
+    def __init__(self, ids_1: numpy.ndarray, ids_2: numpy.ndarray, winners: numpy.ndarray,
+                 timestamps: numpy.ndarray, skills: numpy.ndarray = None, initial_rating: int = 2200):
+        order = numpy.argsort(timestamps, kind="stable")
+        self.ids_1 = numpy.asarray(ids_1)[order]
+        self.ids_2 = numpy.asarray(ids_2)[order]
+        self.winners = numpy.asarray(winners)[order]
+        self.timestamps = numpy.asarray(timestamps)[order]
+        self.skills = skills
+        self.initial_rating = initial_rating
+        self.num_players = max(int(self.ids_1.max(initial=-1)), int(self.ids_2.max(initial=-1))) + 1
+        if skills is not None:
+            self.num_players = max(self.num_players, len(skills))
+        self.games_played = numpy.bincount(numpy.concatenate((self.ids_1.ravel(), self.ids_2.ravel())),
+                                           minlength=self.num_players)
+        self._levels = _levels(numpy.hstack((self.ids_1, self.ids_2)), self.num_players)
+
+    @staticmethod
+    def from_replay_file(path: str, skills: numpy.ndarray = None) -> 'Recalibration':
+        reader = ReplayReader(path)
+        return Recalibration(reader.team_1, reader.team_2, reader.winner, reader.timestamp, skills)
+
+    @staticmethod
+    def from_replays(replays: List[Replay], skills: numpy.ndarray = None) -> 'Recalibration':
+        """From Replay objects, e.g. DataStore.replays."""
+        ids_1 = numpy.array([[p.id for p in r.team_1] for r in replays], dtype=int).reshape(len(replays), -1)
+        ids_2 = numpy.array([[p.id for p in r.team_2] for r in replays], dtype=int).reshape(len(replays), -1)
+        return Recalibration(ids_1, ids_2, [r.winner_ind for r in replays], [r.timestamp for r in replays], skills)
+
+    def run(self, algorithm, track: List[int] = None) -> Tuple[numpy.ndarray, Dict]:
+        """
+        Rate all games and return the final ratings by player id, plus a report with the fraction of games
+        won by the team with the higher mean rating before the game. With `track`, the report holds the
+        rating trajectory, as (timestamp, rating) pairs, of each of those player ids.
+        """
+        state = algorithm.start(numpy.full(self.num_players, float(self.initial_rating)))
+        ratings = state["ratings"]
+        num_predicted = 0
+        trajectories = {player_id: [] for player_id in track or []}
+        tracked = numpy.isin(numpy.arange(self.num_players), track or [])
+        for games in self._levels:
+            ids_1, ids_2, winners = self.ids_1[games], self.ids_2[games], self.winners[games]
+            favourite = numpy.where(ratings[ids_1].mean(axis=1) >= ratings[ids_2].mean(axis=1), 0, 1)
+            num_predicted += int((favourite == winners).sum())
+            algorithm.update(state, ids_1, ids_2, winners)
+            if len(trajectories) > 0:
+                self._record(trajectories, tracked, ratings, games)
+        report = {"prediction_accuracy": num_predicted / max(1, len(self.winners)), "trajectories": trajectories}
+        if self.skills is not None:
+            report.update(self.fit(ratings))
+        return ratings, report
+
+    def fit(self, ratings: numpy.ndarray) -> Dict[str, float]:
+        """How well the ratings of players with at least one game match their skill."""
+        played = self.games_played[:len(self.skills)] > 0
+        r, s = ratings[:len(self.skills)][played], numpy.asarray(self.skills)[played]
+        if len(r) < 2:
+            return {"pearson": float("nan"), "spearman": float("nan"), "rmse": float("nan")}
+        return {
+            "pearson": float(numpy.corrcoef(r, s)[0, 1]),
+            "spearman": float(numpy.corrcoef(_ranks(r), _ranks(s))[0, 1]),
+            "rmse": float(numpy.sqrt(numpy.mean((r - s) ** 2))),
+        }
+
+    def search(self, algorithm_factory, params: Dict[str, Sequence]) -> List[dict]:
+        """Try every combination of params, e.g. search(EloRating, {"k": [8, 16, 32, 64]})."""
+        keys = sorted(params)
+        rows = []
+        for values in itertools.product(*(params[k] for k in keys)):
+            point = dict(zip(keys, values))
+            _, report = self.run(algorithm_factory(**point))
+            del report["trajectories"]
+            rows.append(dict(point, **report))
+        rows.sort(key=lambda row: -row["prediction_accuracy"])
+        print_rows(rows)
+        return rows
+
+    def _record(self, trajectories, tracked, ratings, games):
+        for ids, timestamp in zip(numpy.hstack((self.ids_1[games], self.ids_2[games])), self.timestamps[games]):
+            for player_id in ids[tracked[ids]].tolist():
+                trajectories[player_id].append((int(timestamp), float(ratings[player_id])))
+
+
+def player_skills(engine: Engine, environment: Environment) -> numpy.ndarray:
+    """Ground-truth skill by engine player id."""
+    return numpy.array([environment.get_player_skill(engine.player(i).name) for i in range(len(engine.players))])
+
+
+def print_rows(rows: List[dict]) -> None:
+    if len(rows) == 0:
+        return
+    print("")
+    print("".join(k.rjust(22) for k in rows[0]))
+    for row in rows:
+        print("".join(("%.4g" % v if isinstance(v, float) else str(v)).rjust(22) for v in row.values()))
+
+
+def _levels(ids: numpy.ndarray, num_players: int) -> List[numpy.ndarray]:
+    level_of_player = [0] * num_players
+    levels = [0] * len(ids)
+    for game, players in enumerate(ids.tolist()):
+        level = max(map(level_of_player.__getitem__, players))
+        levels[game] = level
+        for p in players:
+            level_of_player[p] = level + 1
+    levels = numpy.array(levels, dtype=int)
+    order = numpy.argsort(levels, kind="stable")
+    starts = numpy.flatnonzero(numpy.diff(levels[order])) + 1
+    return numpy.split(order, starts) if len(ids) > 0 else []
+
+
+def _ranks(values: numpy.ndarray) -> numpy.ndarray:
+    ranks = numpy.empty(len(values))
+    ranks[numpy.argsort(values, kind="stable")] = numpy.arange(len(values))
+    return ranks
@@ -0,0 +1,111 @@
+import os
+from typing import Dict, Tuple
+
+import numpy
+
+from core.common import Replay
+from core.matchmakers import TEAM_SIZE
+
+# column name -> (dtype, values per replay)
+COLUMNS = {
+    "timestamp": (numpy.int64, 1),
+    "team_1": (numpy.int32, TEAM_SIZE),
+    "team_2": (numpy.int32, TEAM_SIZE),
+    "winner": (numpy.int8, 1),
+    "length": (numpy.int32, 1),
+    "mmr_diff": (numpy.float32, 1),
+    "max_mmr_diff": (numpy.int32, 1),
+}
+
+
+class ReplayWriter:
+    """
+    Append-only columnar replay file: a directory with one raw binary file per column. Replays are
+    buffered and written in batches; players are stored by id.
+    """
+
+    def __init__(self, path: str, batch_size: int = 4096):
+        self.path = path
+        self.batch_size = batch_size
+        self.num_written = 0
+        self._buffer = {column: [] for column in COLUMNS}
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, replay: Replay) -> None:
+        self._buffer["timestamp"].append(replay.timestamp)
+        self._buffer["team_1"].append([p.id for p in replay.team_1])
+        self._buffer["team_2"].append([p.id for p in replay.team_2])
+        self._buffer["winner"].append(replay.winner_ind)
+        self._buffer["length"].append(replay.game_length)
+        self._buffer["mmr_diff"].append(replay.mmr_diff)
+        self._buffer["max_mmr_diff"].append(replay.max_mmr_diff)
+        if len(self._buffer["timestamp"]) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        num_buffered = len(self._buffer["timestamp"])
+        if num_buffered == 0:
+            return
+        for column, (dtype, _) in COLUMNS.items():
+            with open(_column_path(self.path, column), "ab") as f:
+                numpy.asarray(self._buffer[column], dtype=dtype).tofile(f)
+            self._buffer[column] = []
+        self.num_written += num_buffered
+
+    def close(self) -> None:
+        self.flush()
+
+
+class ReplayReader:
+    """Memory-maps the columns written by a ReplayWriter, so replays can be analysed without loading objects."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.columns = _map_columns(path)
+
+    def __len__(self):
+        return len(self.columns["timestamp"])
+
+    def __getattr__(self, column):
+        if column in COLUMNS:
+            return self.columns[column]
+        raise AttributeError(column)
+
+    def games_and_wins(self, num_players: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Number of games and wins per player id."""
+        team_1, team_2, winner = self.columns["team_1"], self.columns["team_2"], self.columns["winner"]
+        games = numpy.bincount(team_1.ravel(), minlength=num_players) + \
+            numpy.bincount(team_2.ravel(), minlength=num_players)
+        winners = numpy.where(winner[:, None] == 0, team_1, team_2)
+        wins = numpy.bincount(winners.ravel(), minlength=num_players)
+        return games, wins
+
+    def win_rates(self, num_players: int) -> numpy.ndarray:
+        games, wins = self.games_and_wins(num_players)
+        played = games > 0
+        return wins[played] / games[played]
+
+    def histogram(self, column: str, bins: int = 20, value_range: Tuple[float, float] = None):
+        return numpy.histogram(self.columns[column], bins=bins, range=value_range)
+
+
+def _column_path(path: str, column: str) -> str:
+    return os.path.join(path, column + ".bin")
+
+
+def _map_columns(path: str) -> Dict[str, numpy.ndarray]:
+    sizes = dict()
+    for column, (dtype, width) in COLUMNS.items():
+        column_path = _column_path(path, column)
+        num_bytes = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+        sizes[column] = num_bytes // (numpy.dtype(dtype).itemsize * width)
+    # a writer may be in the middle of a batch; only expose complete rows
+    num_rows = min(sizes.values())
+    columns = dict()
+    for column, (dtype, width) in COLUMNS.items():
+        shape = (num_rows, width) if width > 1 else (num_rows,)
+        if num_rows == 0:
+            columns[column] = numpy.empty(shape, dtype=dtype)
+        else:
+            columns[column] = numpy.memmap(_column_path(path, column), dtype=dtype, mode="r", shape=shape)
+    return columns
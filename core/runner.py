@@ -1,10 +1,29 @@
-from typing import List, Tuple
-import matplotlib.pyplot as plt
-from core.common import MatchMaker, Environment, Statistics, debug
+import copy
+import random
+from multiprocessing import Pool
+from typing import List, Tuple, Dict
+import numpy
+from core.common import MatchMaker, Environment, Statistics, MmrEngine, Histogram, debug
 from core.engine import Engine
+from core.mmr_engine import BaseMmrEngine
+
+METRICS = ["num_games", "avg_queue_time", "p95_queue_time", "avg_max_mmr_diff", "avg_game_length", "queue_length"]
+
+# two-sided 95% quantiles of Student's t-distribution, by degrees of freedom
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
 
 
 class Runner:
+    """
+    A run is a tuple (name, match_maker, environment) with an optional fourth element, the MMR engine
+    (BaseMmrEngine by default). The environment may be given as a factory (e.g. the AdvancedEnvironment
+    class) so that each seeded replicate gets its own population; the MMR engine may be given as a
+    factory taking the environment (e.g. the CheatingMmrEngine class). With
+    partial(TraceEnvironment.from_file, path) every configuration and replicate replays the same
+    recorded workload (see core.trace).
+    """
 
     def __init__(self, num_players=95, num_rounds=2000, min_mmr=0, max_mmr=100000):
         self.num_players = num_players
@@ -12,21 +31,45 @@ class Runner:
         self.min_mmr = min_mmr
         self.max_mmr = max_mmr
 
-    def run_and_plot(self, runs: List[Tuple[str, MatchMaker, Environment]]) -> None:
-        for i, run in enumerate(runs):
-            (name, match_maker, environment) = run
+    def run_and_plot(self, runs: List[Tuple], path: str = None) -> None:
+        statistics = []
+        for run in runs:
+            name = run[0]
             debug("Running " + name + " ...")
-            self._run_and_plot(i, len(runs), name, match_maker, environment)
-        plt.show()
+            statistics.append(self._run(run))
+        plot(statistics, path)
 
-    def _run_and_plot(self, plot_index, num_plots, name, match_maker, environment):
-        engine = Engine(match_maker, environment)
-        for i in range(self.num_rounds):
-            engine.one_round()
+    def _run(self, run) -> Statistics:
+        name, engine = _create_engine(run)
+        engine.run(self.num_rounds, event_driven=True)
         target_players = engine.players_with_mmr_between(self.min_mmr, self.max_mmr)
         stats = engine.statistics(target_players)
+        engine.close()
         Runner._print_stats(name, stats)
-        Runner._plot(plot_index, num_plots, stats)
+        return stats
+
+    def compare(self, runs: List[Tuple], replicates: int = 20, processes: int = None,
+                base_seed: int = 0) -> Dict[str, Dict[str, Tuple[float, float]]]:
+        """
+        Run every configuration with the same `replicates` seeds, spread over a process pool, and
+        return (mean, 95% confidence half-width) per metric and configuration.
+        """
+        jobs = [(run, base_seed + seed, self.num_rounds, self.min_mmr, self.max_mmr)
+                for run in runs for seed in range(replicates)]
+        if processes == 1:
+            summaries = [run_replicate(*job) for job in jobs]
+        else:
+            with Pool(processes) as pool:
+                summaries = pool.starmap(run_replicate, jobs, chunksize=1)
+        results = dict()
+        pooled = dict()
+        for i, run in enumerate(runs):
+            replicate_summaries = summaries[i * replicates: (i + 1) * replicates]
+            results[run[0]] = {m: confidence_interval([s[m] for s in replicate_summaries]) for m in METRICS}
+            pooled[run[0]] = merge_sketches([s["wait_time_sketch"] for s in replicate_summaries]).percentiles()
+        Runner._print_comparison(results, replicates)
+        Runner._print_pooled_percentiles(pooled)
+        return results
 
     @staticmethod
     def _print_stats(name, stats):
@@ -40,7 +83,25 @@ class Runner:
         print("Queue state: " + str(stats.queue))
 
     @staticmethod
-    def _plot(plot_index, num_plots, statistics: Statistics):
+    def _print_comparison(results, replicates):
+        print("")
+        print("Mean and 95% confidence interval over " + str(replicates) + " replicates")
+        print("--------------------------")
+        print("".join(m.rjust(22) for m in [""] + METRICS))
+        for name, metrics in results.items():
+            cells = ["%.1f ± %.1f" % metrics[m] for m in METRICS]
+            print(name[:21].rjust(22) + "".join(c.rjust(22) for c in cells))
+
+    @staticmethod
+    def _print_pooled_percentiles(pooled):
+        print("")
+        print("Queue time percentiles over all replicates")
+        print("--------------------------")
+        for name, percentiles in pooled.items():
+            print(name[:21].rjust(22) + "".join((p + ": " + str(v)).rjust(16) for p, v in percentiles.items()))
+
+    @staticmethod
+    def _plot(plt, plot_index, num_plots, statistics: Statistics):
         ver = 2
         hor = 2
         diagrams = ver * hor
@@ -49,16 +110,90 @@ class Runner:
 
         plt.subplot(ver * num_plots, hor, 1 + plot_index*diagrams)
         plt.title("max MMR-diff")
-        plt.hist(statistics.mmr_diffs, range=[0, 3500], bins=bins)
+        plt.hist(statistics.mmr_diffs.values(), weights=statistics.mmr_diffs.counts(), range=[0, 3500], bins=bins)
 
         plt.subplot(ver * num_plots, hor, 2 + plot_index*diagrams)
         plt.title("queue time")
-        plt.hist(statistics.wait_times, range=[0, 50], bins=bins)
+        plt.hist(statistics.wait_times.values(), weights=statistics.wait_times.counts(), range=[0, 50], bins=bins)
 
         plt.subplot(ver * num_plots, hor, 3 + plot_index*diagrams)
         plt.title("game length")
-        plt.hist(statistics.game_lengths, range=[0, 40], bins=bins)
+        plt.hist(statistics.game_lengths.values(), weights=statistics.game_lengths.counts(), range=[0, 40], bins=bins)
 
         plt.subplot(ver * num_plots, hor, 4 + plot_index*diagrams)
         plt.title("win-rate")
         plt.hist(statistics.win_rates, range=[0, 1], bins=bins)
+
+
+def plot(statistics: List[Statistics], path: str = None) -> None:
+    """Shows the plots in a window, or with `path`, writes them to that image file without needing a display."""
+    plt = pyplot(interactive=path is None)
+    for i, stats in enumerate(statistics):
+        Runner._plot(plt, i, len(statistics), stats)
+    if path is None:
+        plt.show()
+    else:
+        plt.savefig(path)
+        plt.close()
+
+
+def run_replicate(run: Tuple, seed: int, num_rounds: int, min_mmr: int, max_mmr: int) -> Dict[str, float]:
+    """Run one seeded replicate of a configuration and return only its summary metrics."""
+    random.seed(seed)
+    numpy.random.seed(seed)
+    _, engine = _create_engine(copy.deepcopy(run))
+    engine.run(num_rounds, event_driven=True)
+    stats = engine.statistics(engine.players_with_mmr_between(min_mmr, max_mmr))
+    engine.close()
+    return summarize(stats)
+
+
+def summarize(stats: Statistics) -> Dict[str, float]:
+    """Summary metrics, plus the queue time sketch (as a dict) so that replicates can be pooled."""
+    p95_queue_time = stats.wait_times.quantile(0.95)
+    return {
+        "num_games": stats.num_games,
+        "avg_queue_time": stats.avg_queue_time,
+        "p95_queue_time": p95_queue_time if p95_queue_time is not None else -1,
+        "avg_max_mmr_diff": stats.avg_max_mmr_diff,
+        "avg_game_length": stats.avg_game_length,
+        "queue_length": len(stats.queue),
+        "wait_time_sketch": stats.wait_times.to_dict(),
+    }
+
+
+def merge_sketches(sketches: List[Dict]) -> Histogram:
+    merged = Histogram.from_dict(sketches[0])
+    for sketch in sketches[1:]:
+        merged.merge(Histogram.from_dict(sketch))
+    return merged
+
+
+def confidence_interval(samples: List[float]) -> Tuple[float, float]:
+    mean = float(numpy.mean(samples))
+    if len(samples) < 2:
+        return mean, float("nan")
+    df = len(samples) - 1
+    t = T_95[df - 1] if df <= len(T_95) else 1.96
+    return mean, float(t * numpy.std(samples, ddof=1) / numpy.sqrt(len(samples)))
+
+
+def pyplot(interactive: bool):
+    # matplotlib is slow to import and only needed for plots
+    import matplotlib
+    if not interactive:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _create_engine(run: Tuple) -> Tuple[str, Engine]:
+    name, match_maker, environment = run[:3]
+    mmr_engine = run[3] if len(run) > 3 else BaseMmrEngine()
+    if not isinstance(environment, Environment):
+        environment = environment()
+    if not isinstance(mmr_engine, MmrEngine):
+        mmr_engine = mmr_engine(environment)
+    if not isinstance(match_maker, MatchMaker):
+        raise Exception("Bad argument: " + str(match_maker))
+    return name, Engine(match_maker, mmr_engine, environment)
@@ -0,0 +1,325 @@
+import asyncio
+import json
+from heapq import heappush, heappop
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import numpy
+
+from core.common import Environment, Game, Player, Queuer, MatchMaker, MmrEngine
+from core.engine import Engine, DataStore
+from core.environments import AdvancedEnvironment
+from core.mmr_engine import BaseMmrEngine
+
+class ServiceEnvironment(Environment):
+    """Players queue and leave when clients ask them to, and games last until a client reports their result."""
+
+    def __init__(self, on_lobby):
+        self.games = dict()
+        self._on_lobby = on_lobby
+        self._num_lobbies = 0
+        self._add_to_queue = None
+        self._remove_from_queue = None
+
+    def register_callbacks(self, add_to_queue, remove_from_queue):
+        self._add_to_queue = add_to_queue
+        self._remove_from_queue = remove_from_queue
+
+    def enqueue(self, player_name: str) -> None:
+        self._add_to_queue(player_name)
+
+    def dequeue(self, queuer: Queuer) -> None:
+        self._remove_from_queue(queuer)
+
+    def one_round(self) -> None:
+        pass
+
+    def next_event_in(self) -> Optional[int]:
+        return None
+
+    def skip_rounds(self, num_rounds: int) -> None:
+        pass
+
+    def on_game_finished(self, game: Game) -> None:
+        pass
+
+    def new_game(self, team_1: List[Player], team_2: List[Player]) -> Game:
+        # lasts until its result is reported
+        game = Game(None, team_1, team_2, 0)
+        lobby_id = self._num_lobbies
+        self._num_lobbies += 1
+        self.games[lobby_id] = game
+        self._on_lobby(lobby_id, game)
+        return game
+
+    def player_happiness(self, player: Player) -> float:
+        pass
+
+    def get_player_skill(self, player_name: str) -> int:
+        raise Exception("Skill is unknown to the service: " + player_name)
+
+
+class MatchmakingService:
+    """
+    Runs an Engine behind a local TCP or Unix socket. Requests are newline-delimited JSON objects:
+
+        {"op": "enqueue", "player": name}
+        {"op": "dequeue", "player": name}
+        {"op": "result", "lobby": lobby_id, "winner": 0 or 1}
+
+    Requests are buffered and applied together at the start of each tick, which then runs one engine
+    round. A found lobby is pushed as {"op": "lobby", "lobby": lobby_id, "team_1": [...], "team_2": [...]}
+    to every connection that enqueued one of its players; rejected requests get {"op": "error", ...}.
+    Players of a closed connection are taken out of the queue. A request or round that raises is counted
+    in num_errors (the last one is kept in last_error) and the service keeps ticking. With matchmaking_budget_ms, the lobby
+    search of a tick is cut off after that long and continued in the next tick (see Engine).
+    """
+
+    def __init__(self, match_maker: MatchMaker, mmr_engine: MmrEngine = None, tick_ms: int = 50,
+                 data_store: DataStore = None, matchmaking_budget_ms: float = None):
+        self.environment = ServiceEnvironment(self._on_lobby)
+        self.engine = Engine(match_maker, mmr_engine or BaseMmrEngine(), self.environment,
+                             data_store or DataStore(keep_replays=False), matchmaking_budget_ms)
+        self.tick_ms = tick_ms
+        self.num_requests = 0
+        self.num_ticks = 0
+        self.num_errors = 0
+        self.last_error = None
+        self._pending = []
+        self._owners = dict()
+        self._server = None
+        self._ticker = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: str = None):
+        """Listen on the Unix socket `path` if given, else on host:port (port 0 picks a free port)."""
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        self._ticker = asyncio.ensure_future(self._tick_loop())
+        return self._server
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._ticker.cancel()
+        self._server.close()
+        # let handlers see their connections close
+        await asyncio.sleep(0)
+        await self._server.wait_closed()
+        self.engine.close()
+
+    def tick(self) -> None:
+        pending, self._pending = self._pending, []
+        for request, writer in pending:
+            try:
+                self._apply(request, writer)
+            except Exception as e:
+                self._on_error(e)
+                _error(writer, request, "Failed: " + str(e))
+        try:
+            self.engine.one_round()
+        except Exception as e:
+            self._on_error(e)
+        self.num_ticks += 1
+
+    def _on_error(self, error: Exception) -> None:
+        self.num_errors += 1
+        self.last_error = error
+
+    async def _tick_loop(self):
+        loop = asyncio.get_event_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick_ms / 1000.0
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            self.tick()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    _send(writer, {"op": "error", "error": "Bad request"})
+                    continue
+                if not isinstance(request, dict):
+                    _send(writer, {"op": "error", "error": "Bad request"})
+                    continue
+                self.num_requests += 1
+                self._pending.append((request, writer))
+        except ConnectionError:
+            pass
+        finally:
+            self._pending.append(({"op": "disconnect"}, writer))
+            writer.close()
+
+    def _apply(self, request: Dict, writer):
+        op = request.get("op")
+        if op == "enqueue":
+            name = request.get("player")
+            if not isinstance(name, str) or name in self._owners:
+                return _error(writer, request, "Already queued or playing")
+            self._owners[name] = writer
+            self.environment.enqueue(name)
+        elif op == "dequeue":
+            queuer = self._queuer_of(request.get("player"))
+            if queuer is None:
+                return _error(writer, request, "Not queued")
+            self.environment.dequeue(queuer)
+            del self._owners[queuer.player.name]
+        elif op == "result":
+            lobby, winner = request.get("lobby"), request.get("winner")
+            # bools are ints too, but True is no lobby id or winner index
+            if type(lobby) is not int or lobby not in self.environment.games or type(winner) is not int \
+                    or winner not in (0, 1):
+                return _error(writer, request, "Unknown lobby or winner")
+            game = self.environment.games.pop(lobby)
+            self.engine.finish_game(game, winner)
+            for p in game.team_1 + game.team_2:
+                self._owners.pop(p.name, None)
+        elif op == "disconnect":
+            for name in [name for name, owner in self._owners.items() if owner is writer]:
+                queuer = self._queuer_of(name)
+                if queuer is not None:
+                    self.environment.dequeue(queuer)
+                    del self._owners[name]
+        else:
+            _error(writer, request, "Unknown op")
+
+    def _queuer_of(self, player_name) -> Optional[Queuer]:
+        player = self.engine.players.get(player_name)
+        return self.engine.queue().queuer_of(player) if player is not None else None
+
+    def _on_lobby(self, lobby_id: int, game: Game):
+        message = {"op": "lobby", "lobby": lobby_id, "team_1": [p.name for p in game.team_1],
+                   "team_2": [p.name for p in game.team_2]}
+        notified = []
+        for p in game.team_1 + game.team_2:
+            owner = self._owners.get(p.name)
+            if owner is not None and all(owner is not w for w in notified):
+                _send(owner, message)
+                notified.append(owner)
+
+
+class LoadGenerator:
+    """
+    Simulated clients for a MatchmakingService. An AdvancedEnvironment decides when players queue and how
+    their games go: every tick advances it by rounds_per_tick rounds, sends the enqueues this causes and
+    reports the results of games whose simulated length has passed. Measures the request rate and the
+    latency from sending an enqueue to receiving the player's lobby.
+    """
+
+    def __init__(self, environment: AdvancedEnvironment = None, rounds_per_tick: int = 10, tick_ms: int = 10):
+        self.environment = environment or AdvancedEnvironment(10000, 2000)
+        self.environment.register_callbacks(self._enqueue, self._dequeue)
+        self.rounds_per_tick = rounds_per_tick
+        self.tick_ms = tick_ms
+        self.num_sent = 0
+        self.num_lobbies = 0
+        self.latencies = []
+        self._round = 0
+        self._enqueued_at = dict()
+        self._results = []
+        self._num_results = 0
+        self._writer = None
+
+    async def run(self, seconds: float, host: str = "127.0.0.1", port: int = None, path: str = None) -> Dict:
+        if path is not None:
+            reader, self._writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, self._writer = await asyncio.open_connection(host, port)
+        receiver = asyncio.ensure_future(self._receive(reader))
+        start = perf_counter()
+        while perf_counter() - start < seconds:
+            for _ in range(self.rounds_per_tick):
+                self._round += 1
+                self.environment.one_round()
+                self._report_results()
+            await self._writer.drain()
+            await asyncio.sleep(self.tick_ms / 1000.0)
+        elapsed = perf_counter() - start
+        receiver.cancel()
+        self._writer.close()
+        await self._writer.wait_closed()
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict:
+        latencies_ms = numpy.array(self.latencies) * 1000
+        return {
+            "seconds": elapsed,
+            "requests": self.num_sent,
+            "requests_per_s": self.num_sent / elapsed,
+            "lobbies": self.num_lobbies,
+            "latency_ms": {"p" + str(p): float(numpy.percentile(latencies_ms, p)) if len(latencies_ms) > 0
+                           else None for p in (50, 95, 99)},
+        }
+
+    def _send(self, request: Dict):
+        _send(self._writer, request)
+        self.num_sent += 1
+
+    def _enqueue(self, player_name: str):
+        self._enqueued_at[player_name] = perf_counter()
+        self._send({"op": "enqueue", "player": player_name})
+
+    def _dequeue(self, player_name: str):
+        self._enqueued_at.pop(player_name, None)
+        self._send({"op": "dequeue", "player": player_name})
+
+    async def _receive(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message["op"] == "lobby":
+                self._on_lobby(message)
+
+    def _on_lobby(self, message: Dict):
+        now = perf_counter()
+        self.num_lobbies += 1
+        for name in message["team_1"] + message["team_2"]:
+            self.latencies.append(now - self._enqueued_at.pop(name))
+        game = self.environment.new_game([Player(name, 0) for name in message["team_1"]],
+                                         [Player(name, 0) for name in message["team_2"]])
+        heappush(self._results, (self._round + max(game.length, 1), self._num_results, message["lobby"], game))
+        self._num_results += 1
+
+    def _report_results(self):
+        while len(self._results) > 0 and self._results[0][0] <= self._round:
+            _, _, lobby_id, game = heappop(self._results)
+            self.environment.on_game_finished(game)
+            self._send({"op": "result", "lobby": lobby_id, "winner": game.winner_index})
+
+
+def run_load_test(match_maker: MatchMaker, seconds: float = 10, generator: LoadGenerator = None,
+                  service_tick_ms: int = 50, matchmaking_budget_ms: float = None) -> Dict:
+    """
+    Run a service and a load generator against it in one event loop and return the generator's report,
+    plus the service's budget metrics when it has a matchmaking budget.
+    """
+    async def load_test():
+        service = MatchmakingService(match_maker, tick_ms=service_tick_ms, matchmaking_budget_ms=matchmaking_budget_ms)
+        await service.start()
+        try:
+            report = await (generator or LoadGenerator()).run(seconds, port=service.port)
+        finally:
+            await service.stop()
+        if service.engine.budget_metrics is not None:
+            report["matchmaking_budget"] = service.engine.budget_metrics.summary()
+        return report
+    return asyncio.run(load_test())
+
+
+def _send(writer, message: Dict):
+    writer.write((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def _error(writer, request: Dict, error: str):
+    _send(writer, {"op": "error", "error": error, "request": request})
@@ -0,0 +1,273 @@
+from bisect import bisect_right
+from heapq import heappush, heappop
+from multiprocessing import Pipe, Process
+from typing import List
+
+from core.common import MatchMaker, Queue, Queuer, Player, Clock, Histogram
+from core.engine import wait_time_sketch
+from core.matchmakers import TEAM_SIZE, mmr_index
+
+# shard index of queuers handled by the coordinator's cross-shard pass
+CROSS_SHARD = -1
+# asks a worker for the wait times of the lobbies it formed since it was last asked
+WAIT_TIMES = 'wait_times'
+
+
+class ShardedMatchmaker(MatchMaker):
+    """
+    Splits the queue by MMR band over worker processes, each running its own copy of match_maker on a
+    shadow queue. The coordinator only sends what changed in the queue since the last round (read from
+    the MMR index's journal), so the per-round cost in this process grows with the queue churn, not with
+    the queue length.
+
+    Queuers that are within edge_width of a band boundary and have waited handoff_wait rounds are handed
+    off to a cross-shard pass that runs match_maker over them in this process, while the workers search
+    their bands. The workers form nearly all lobbies: the hand-off is for the few players whose partners
+    are on the other side of a boundary.
+
+    Sharding pays off when searching the queue costs more per player than sending its changes over, as with
+    fair_method (see micro/sharding in benchmark.py); a cheap search such as BatchMatchmaker's is faster left
+    unsharded. A round trip to the workers costs more than searching a small queue, so the queue is only sharded
+    once it holds min_queue_size players; below half that, the workers are stopped and match_maker runs
+    over the whole queue here again. Engine.close() stops the workers as well.
+
+    Unless boundaries are given, they are placed at MMR quantiles of each queue the matchmaker is
+    pointed at, skipping quantiles whose edge zone would hold more than a band's share of the queue
+    (a whole population at its starting MMR goes to one band, not to the cross-shard pass). When the
+    bands grow lopsided, the boundaries are placed again and the players that changed band move over.
+    """
+
+    def __init__(self, match_maker: MatchMaker, num_shards: int = 4, boundaries: List[int] = None,
+                 edge_width: int = 25, handoff_wait: int = 200, min_queue_size: int = 2000):
+        self.match_maker = match_maker
+        self.num_shards = len(boundaries) + 1 if boundaries is not None else num_shards
+        self.boundaries = boundaries
+        self.edge_width = edge_width
+        self.handoff_wait = handoff_wait
+        self.min_queue_size = min_queue_size
+        self.lobbies_per_shard = [0] * (self.num_shards + 1)
+        self.wait_times_per_shard = [wait_time_sketch() for _ in range(self.num_shards + 1)]
+        self._reset()
+
+    def __getstate__(self):
+        # worker processes can't be copied; a copy starts its own on the next search
+        state = dict(self.__dict__)
+        state.update(_by_mmr=None, _workers=[], _shard_of=dict(), _cross=Queue(), _waiting=[])
+        return state
+
+    def _reset(self):
+        self._by_mmr = None
+        self._boundaries = self.boundaries
+        self._workers = []
+        # (shard, queuer, key) of each queued player by the insertion number in its key, which the
+        # workers get to know the player by
+        self._shard_of = dict()
+        self._cross = Queue()
+        # heap of (enqueue round, key) of the players sent to a band near its edge, to hand them off in time
+        self._waiting = []
+        self._round = 0
+
+    def find_lobbies(self, queue: Queue, found_lobby_callback) -> None:
+        by_mmr = mmr_index(queue)
+        if by_mmr is self._by_mmr and len(by_mmr) < self.min_queue_size // 2:
+            self.close()
+        if by_mmr is not self._by_mmr:
+            if len(by_mmr) < max(self.min_queue_size, self.num_shards * TEAM_SIZE * 4):
+                self.match_maker.find_lobbies(queue, found_lobby_callback)
+                return
+            self._watch(by_mmr)
+        if len(by_mmr) > 0:
+            first = by_mmr[0]
+            self._round = first.enqueued_at + first.waited
+        removed, added = self._apply_journal()
+        if self.boundaries is None:
+            self._rebalance(removed, added)
+        self._hand_off_long_waiters(removed, added)
+        for shard, (connection, _) in enumerate(self._workers):
+            connection.send((self._round, removed[shard], list(added[shard].values())))
+        # the workers search their bands meanwhile
+        self.match_maker.find_lobbies(self._cross, lambda t1, t2: self._on_cross_lobby(t1, t2, found_lobby_callback))
+        for shard, (connection, _) in enumerate(self._workers):
+            # the players of each lobby back to back, first team first; the worker keeps their wait times
+            seqs = connection.recv()
+            self.lobbies_per_shard[shard] += len(seqs) // (2 * TEAM_SIZE)
+            for i in range(0, len(seqs), 2 * TEAM_SIZE):
+                team_1 = [self._shard_of.pop(seq)[1] for seq in seqs[i:i + TEAM_SIZE]]
+                team_2 = [self._shard_of.pop(seq)[1] for seq in seqs[i + TEAM_SIZE:i + 2 * TEAM_SIZE]]
+                found_lobby_callback(team_1, team_2)
+
+    def close(self) -> None:
+        for shard, (connection, process) in enumerate(self._workers):
+            connection.send(None)
+            self.wait_times_per_shard[shard].merge(connection.recv())
+            process.join()
+        if self._by_mmr is not None:
+            self._by_mmr.journal = None
+        self._reset()
+
+    def shard_of(self, mmr: int) -> int:
+        return bisect_right(self._boundaries, mmr)
+
+    def near_edge(self, mmr: int) -> bool:
+        return self._near_edge(mmr, self.shard_of(mmr))
+
+    def _near_edge(self, mmr: int, shard: int) -> bool:
+        near_lower = shard > 0 and mmr - self._boundaries[shard - 1] < self.edge_width
+        near_upper = shard < len(self._boundaries) and self._boundaries[shard] - mmr <= self.edge_width
+        return near_lower or near_upper
+
+    def wait_times(self) -> Histogram:
+        """Wait times of the matched players, merged over the shards and the cross-shard pass."""
+        for shard, (connection, _) in enumerate(self._workers):
+            connection.send(WAIT_TIMES)
+            self.wait_times_per_shard[shard].merge(connection.recv())
+        merged = wait_time_sketch()
+        for histogram in self.wait_times_per_shard:
+            merged.merge(histogram)
+        return merged
+
+    def _watch(self, by_mmr):
+        self.close()
+        self._by_mmr = by_mmr
+        if self.boundaries is None:
+            self._boundaries = self._infer_boundaries()
+        for _ in range(self.num_shards):
+            connection, worker_connection = Pipe()
+            process = Process(target=_shard_worker, args=(worker_connection, self.match_maker), daemon=True)
+            process.start()
+            self._workers.append((connection, process))
+        # everything that is queued now is sent as added
+        by_mmr.journal = [by_mmr.key(q) for q in by_mmr]
+
+    def _infer_boundaries(self) -> List[int]:
+        by_mmr = self._by_mmr
+        band = len(by_mmr) // self.num_shards
+        boundaries = []
+        for i in range(1, self.num_shards):
+            mmr = by_mmr.mmr(by_mmr[band * i])
+            if boundaries and mmr - boundaries[-1] <= 2 * self.edge_width:
+                continue
+            if by_mmr.rank_of_mmr(mmr + self.edge_width) - by_mmr.rank_of_mmr(mmr - self.edge_width) > band:
+                continue
+            boundaries.append(mmr)
+        return boundaries
+
+    def _largest_band(self, boundaries: List[int]) -> int:
+        ranks = [0] + [self._by_mmr.rank_of_mmr(mmr) for mmr in boundaries] + [len(self._by_mmr)]
+        return max(upper - lower for lower, upper in zip(ranks, ranks[1:]))
+
+    def _rebalance(self, removed, added):
+        if len(self._by_mmr) < self.num_shards * TEAM_SIZE * 4:
+            return
+        largest = self._largest_band(self._boundaries)
+        if largest <= 2 * len(self._by_mmr) // self.num_shards:
+            return
+        boundaries = self._infer_boundaries()
+        # only move players over if that evens out the bands noticeably
+        if self._largest_band(boundaries) > largest * 3 // 4:
+            return
+        self._boundaries = boundaries
+        for shard, queuer, key in list(self._shard_of.values()):
+            if self._shard_for(key, queuer) != shard:
+                self._unassign(key, removed, added)
+                self._assign(key, queuer, self._shard_for(key, queuer), added)
+
+    def _shard_for(self, key, queuer: Queuer) -> int:
+        shard = self.shard_of(key[0])
+        if self._near_edge(key[0], shard) and queuer.enqueued_at <= self._round - self.handoff_wait:
+            return CROSS_SHARD
+        return shard
+
+    def _apply_journal(self):
+        removed = [[] for _ in range(self.num_shards)]
+        added = [dict() for _ in range(self.num_shards)]
+        for key in self._by_mmr.journal:
+            assigned = self._shard_of.get(key[1])
+            if assigned is not None and assigned[2] == key:
+                self._unassign(key, removed, added)
+                continue
+            queuer = self._by_mmr.item(key)
+            # None if the key has been added and removed again since the last round
+            if queuer is not None:
+                self._assign(key, queuer, self._shard_for(key, queuer), added)
+        self._by_mmr.journal.clear()
+        return removed, added
+
+    def _hand_off_long_waiters(self, removed, added):
+        while len(self._waiting) > 0 and self._waiting[0][0] <= self._round - self.handoff_wait:
+            _, key = heappop(self._waiting)
+            assigned = self._shard_of.get(key[1])
+            # the band found no lobby for them in time, and their best partners may be across the edge
+            if assigned is not None and assigned[2] == key and assigned[0] != CROSS_SHARD \
+                    and self._near_edge(key[0], assigned[0]):
+                self._unassign(key, removed, added)
+                self._assign(key, assigned[1], CROSS_SHARD, added)
+
+    def _assign(self, key, queuer: Queuer, shard: int, added):
+        self._shard_of[key[1]] = (shard, queuer, key)
+        if shard == CROSS_SHARD:
+            self._cross.append(queuer)
+        else:
+            added[shard][key[1]] = (key[1], key[0], queuer.player.id, queuer.enqueued_at)
+            if self._near_edge(key[0], shard):
+                heappush(self._waiting, (queuer.enqueued_at, key))
+
+    def _unassign(self, key, removed, added):
+        shard, queuer, _ = self._shard_of.pop(key[1])
+        if shard == CROSS_SHARD:
+            self._cross.remove(queuer)
+        elif key[1] in added[shard]:
+            # added this round and moved on before the worker heard of it
+            del added[shard][key[1]]
+        else:
+            removed[shard].append(key[1])
+
+    def _on_cross_lobby(self, team_1: List[Queuer], team_2: List[Queuer], found_lobby_callback):
+        self._cross.remove_many(team_1 + team_2)
+        for queuer in team_1 + team_2:
+            del self._shard_of[self._by_mmr.key(queuer)[1]]
+        self.lobbies_per_shard[CROSS_SHARD] += 1
+        for queuer in team_1 + team_2:
+            self.wait_times_per_shard[CROSS_SHARD].add(queuer.waited)
+        found_lobby_callback(team_1, team_2)
+
+
+def _shard_worker(connection, match_maker: MatchMaker):
+    """Keeps a shadow queue of one MMR band in sync with the coordinator and runs match_maker over it."""
+    clock = Clock()
+    queue = Queue()
+    by_seq = dict()
+    seq_of = dict()
+    wait_times = wait_time_sketch()
+
+    def on_lobby(team_1, team_2):
+        queue.remove_many(team_1 + team_2)
+        for q in team_1 + team_2:
+            wait_times.add(q.waited)
+            seq = seq_of.pop(q)
+            del by_seq[seq]
+            lobbies.append(seq)
+
+    while True:
+        message = connection.recv()
+        if message is None or message == WAIT_TIMES:
+            connection.send(wait_times)
+            if message is None:
+                return
+            wait_times = wait_time_sketch()
+            continue
+        clock.round, removed, added = message
+        # players the coordinator took out of a lobby found here are already gone
+        gone = [by_seq.pop(seq) for seq in removed if seq in by_seq]
+        queue.remove_many(gone)
+        for queuer in gone:
+            del seq_of[queuer]
+        for seq, mmr, player_id, enqueued_at in added:
+            queuer = Queuer(Player(str(player_id), mmr, player_id), clock)
+            queuer.enqueued_at = enqueued_at
+            by_seq[seq] = queuer
+            seq_of[queuer] = seq
+            queue.append(queuer)
+        lobbies = []
+        match_maker.find_lobbies(queue, on_lobby)
+        connection.send(lobbies)
@@ -0,0 +1,39 @@
+import gzip
+import pickle
+import random
+
+import numpy
+
+from core.engine import Engine
+
+
+def save_snapshot(engine: Engine, path: str) -> None:
+    """
+    Write the full engine state (players, queue, in-flight games, data store, environment, matchmaker
+    and MMR engine) together with the state of the random and numpy.random generators to a gzipped
+    pickle. Listeners are not saved and instrumentation has to be detached first.
+    A replay sink is flushed first; give a restored branch its own sink if it should not append to it.
+    """
+    if engine._data_store.replay_sink is not None:
+        engine._data_store.replay_sink.flush()
+    state = {
+        "engine": engine,
+        "random": random.getstate(),
+        "numpy_random": numpy.random.get_state(),
+    }
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(path: str, restore_random_state: bool = True) -> Engine:
+    """
+    Load an engine saved by save_snapshot. Unless restore_random_state is False, the global random
+    generators continue from where they were when the snapshot was taken, so a restored run is
+    identical to the original one.
+    """
+    with gzip.open(path, "rb") as f:
+        state = pickle.load(f)
+    if restore_random_state:
+        random.setstate(state["random"])
+        numpy.random.set_state(state["numpy_random"])
+    return state["engine"]
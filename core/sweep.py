@@ -0,0 +1,128 @@
+import hashlib
+import itertools
+import json
+import os
+import random
+from functools import partial
+from multiprocessing import Pool
+from typing import Dict, List, Sequence, Tuple
+
+from core.environments import AdvancedEnvironment
+from core.matchmakers import CompositeMatchmaker, find_by_sorted_mmr, fair_method, filtered_find_by_sorted_mmr, \
+    max_mmr_diff, max_mmr_diff_or_long_wait
+from core.runner import run_replicate, confidence_interval, merge_sketches
+
+# builds a matchmaker from the sweep parameters of a configuration
+MATCHMAKERS = {
+    "sorted_mmr": lambda: CompositeMatchmaker(find_by_sorted_mmr),
+    "fair": lambda: CompositeMatchmaker(fair_method),
+    "max_mmr_diff": lambda num_tries, mmr_boundary: CompositeMatchmaker(
+        filtered_find_by_sorted_mmr(num_tries, max_mmr_diff(mmr_boundary))),
+    "max_mmr_diff_or_long_wait": lambda num_tries, mmr_boundary, wait_boundary: CompositeMatchmaker(
+        filtered_find_by_sorted_mmr(num_tries, max_mmr_diff_or_long_wait(mmr_boundary, wait_boundary))),
+}
+
+
+class Sweep:
+    """
+    Grid or random search over the parameters of one of the MATCHMAKERS and the settings of
+    AdvancedEnvironment. Every (configuration, seed) point is cached on disk under a hash of both,
+    so repeating or extending a sweep only runs the new points.
+    """
+
+    def __init__(self, matchmaker: str, params: Dict[str, Sequence] = None, environment: Dict[str, Sequence] = None,
+                 num_rounds: int = 5000, replicates: int = 3, cache_dir: str = ".sweep_cache"):
+        if matchmaker not in MATCHMAKERS:
+            raise Exception("Unknown matchmaker: " + matchmaker)
+        self.matchmaker = matchmaker
+        self.params = params or dict()
+        self.environment = environment or dict()
+        self.num_rounds = num_rounds
+        self.replicates = replicates
+        self.cache_dir = cache_dir
+
+    def grid(self) -> List[dict]:
+        param_points = _product(self.params)
+        environment_points = _product(self.environment)
+        return [self._config(p, e) for p in param_points for e in environment_points]
+
+    def random(self, num_points: int, seed: int = 0) -> List[dict]:
+        rnd = random.Random(seed)
+        return [self._config({k: rnd.choice(v) for k, v in self.params.items()},
+                             {k: rnd.choice(v) for k, v in self.environment.items()})
+                for _ in range(num_points)]
+
+    def run(self, configs: List[dict], processes: int = None) -> List[dict]:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        points = [(config, seed) for config in configs for seed in range(self.replicates)]
+        results = {_key(*point): self._cached(_key(*point)) for point in points}
+        missing = [point for point in points if results[_key(*point)] is None]
+        if len(missing) > 0:
+            with Pool(processes) as pool:
+                for point, summary in zip(missing, pool.imap(_run_point, missing)):
+                    results[_key(*point)] = summary
+                    self._store(_key(*point), summary)
+        rows = []
+        for config in configs:
+            summaries = [results[_key(config, seed)] for seed in range(self.replicates)]
+            rows.append({
+                "params": config["params"],
+                "environment": config["environment"],
+                "num_games": confidence_interval([s["num_games"] for s in summaries]),
+                "queue_time": confidence_interval([s["avg_queue_time"] for s in summaries]),
+                "mmr_spread": confidence_interval([s["avg_max_mmr_diff"] for s in summaries]),
+                # points cached before the sketches were added to the summaries have none
+                "queue_time_p95": merge_sketches([s["wait_time_sketch"] for s in summaries]).quantile(0.95)
+                if all("wait_time_sketch" in s for s in summaries) else None,
+            })
+        print_table(rows)
+        return rows
+
+    def _config(self, params: dict, environment: dict) -> dict:
+        return {"matchmaker": self.matchmaker, "params": params, "environment": environment,
+                "num_rounds": self.num_rounds}
+
+    def _cached(self, key: str):
+        path = os.path.join(self.cache_dir, key + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _store(self, key: str, summary: dict):
+        path = os.path.join(self.cache_dir, key + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(summary, f)
+        os.replace(path + ".tmp", path)
+
+
+def print_table(rows: List[dict]) -> None:
+    print("")
+    print("params".ljust(50) + "environment".ljust(50) + "queue time".rjust(18) + "p95".rjust(8) +
+          "mmr spread".rjust(18) + "games".rjust(16))
+    for row in rows:
+        print(_format_dict(row["params"]).ljust(50) + _format_dict(row["environment"]).ljust(50) +
+              ("%.1f ± %.1f" % row["queue_time"]).rjust(18) + str(row["queue_time_p95"]).rjust(8) +
+              ("%.1f ± %.1f" % row["mmr_spread"]).rjust(18) + ("%.0f ± %.0f" % row["num_games"]).rjust(16))
+
+
+def _run_point(point: Tuple[dict, int]) -> dict:
+    config, seed = point
+    match_maker = MATCHMAKERS[config["matchmaker"]](**config["params"])
+    environment = partial(AdvancedEnvironment, **config["environment"])
+    run = (config["matchmaker"], match_maker, environment)
+    return run_replicate(run, seed, config["num_rounds"], -2**31, 2**31)
+
+
+def _key(config: dict, seed: int) -> str:
+    encoded = json.dumps({"config": config, "seed": seed}, sort_keys=True)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+def _product(grid: Dict[str, Sequence]) -> List[dict]:
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def _format_dict(d: dict) -> str:
+    return ", ".join(k + "=" + str(v) for k, v in sorted(d.items()))
@@ -0,0 +1,44 @@
+from functools import lru_cache
+from itertools import combinations
+from typing import List, Tuple, Callable, Any
+
+import numpy
+
+from core.common import queuer_mmr
+
+
+@lru_cache(maxsize=None)
+def split_signs(team_size: int) -> numpy.ndarray:
+    """
+    Every distinct split of 2 * team_size players into two teams (126 for 5v5), as a matrix of +1
+    (first team) and -1 (second team). The first player is always on the first team, so mirrored
+    splits only appear once.
+    """
+    lobby_size = team_size * 2
+    splits = []
+    for others in combinations(range(1, lobby_size), team_size - 1):
+        mask = (1 << 0) | sum(1 << i for i in others)
+        splits.append([1 if mask >> i & 1 else -1 for i in range(lobby_size)])
+    return numpy.array(splits, dtype=numpy.int8)
+
+
+def best_splits(mmrs: numpy.ndarray) -> numpy.ndarray:
+    """For an (n, 2 * team_size) array of lobby MMRs, the index of the split with the smallest team MMR difference."""
+    signs = split_signs(mmrs.shape[1] // 2)
+    return numpy.abs(mmrs @ signs.T).argmin(axis=1)
+
+
+def balance_teams(lobbies: List[Tuple[List[Any], List[Any]]], mmr_of: Callable[[Any], int] = queuer_mmr) \
+        -> List[Tuple[List[Any], List[Any]]]:
+    """Re-split every lobby into the two teams with the closest average MMR, all lobbies in one NumPy operation."""
+    if len(lobbies) == 0:
+        return []
+    members = [t1 + t2 for t1, t2 in lobbies]
+    mmrs = numpy.array([[mmr_of(m) for m in lobby] for lobby in members], dtype=float)
+    signs = split_signs(mmrs.shape[1] // 2)
+    balanced = []
+    for lobby, split in zip(members, best_splits(mmrs).tolist()):
+        on_team_1 = signs[split] > 0
+        balanced.append(([m for m, first in zip(lobby, on_team_1) if first],
+                         [m for m, first in zip(lobby, on_team_1) if not first]))
+    return balanced
@@ -0,0 +1,102 @@
+from typing import Dict
+
+import numpy
+
+from core.environments import AdvancedEnvironment
+from core.matchmakers import TEAM_SIZE
+
+# array name -> dtype
+ARRAYS = {
+    "skill": numpy.int32,
+    "max_games": numpy.int8,
+    "max_time_queue": numpy.int16,
+    "initial_breaks": numpy.int32,
+    "breaks": numpy.int32,
+    "outcome_noise": numpy.float32,
+    "length_noise": numpy.float32,
+}
+
+
+class Trace:
+    """
+    Everything random in an AdvancedEnvironment, drawn up front: the population, the break a player
+    takes after each of its games (breaks[player id, number of games played before]), and the noise
+    of the outcome and length of the n-th game started. Since none of it depends on when or with whom
+    a player plays, replaying a trace gives every matchmaker the same workload.
+    """
+
+    def __init__(self, arrays: Dict[str, numpy.ndarray]):
+        for name in ARRAYS:
+            if name not in arrays:
+                raise Exception("Bad argument: missing " + name)
+        self.arrays = {name: numpy.asarray(arrays[name], dtype=dtype) for name, dtype in ARRAYS.items()}
+
+    def __getattr__(self, name):
+        if name in ARRAYS:
+            return self.__dict__["arrays"][name]
+        raise AttributeError(name)
+
+    @property
+    def num_players(self) -> int:
+        return len(self.arrays["skill"])
+
+    def save(self, path: str) -> None:
+        # through a file object, so that numpy doesn't add an .npz extension
+        with open(path, "wb") as f:
+            numpy.savez_compressed(f, **self.arrays)
+
+    @staticmethod
+    def load(path: str) -> 'Trace':
+        with numpy.load(path) as arrays:
+            return Trace({name: arrays[name] for name in arrays.files})
+
+
+def record_trace(num_players: int = 1000, num_active_from_start: int = 200, games_per_player: int = 32,
+                 num_games: int = None) -> Trace:
+    """
+    Record the random draws of an AdvancedEnvironment with these arguments (seed numpy.random first for
+    a reproducible trace). A replay that goes past games_per_player games of a player, or num_games
+    games in total (by default enough for every player to play games_per_player games), starts over
+    from the beginning of the recorded breaks or game noise.
+    """
+    environment = AdvancedEnvironment(num_players, num_active_from_start)
+    if num_games is None:
+        num_games = max(1, num_players * games_per_player // (TEAM_SIZE * 2))
+    ids = numpy.repeat(numpy.arange(num_players), games_per_player)
+    games_played = numpy.tile(numpy.arange(games_per_player), num_players)
+    done_for_now = games_played > environment._max_games[ids]
+    breaks = numpy.where(done_for_now, environment._long_breaks(len(ids)), environment._short_breaks(len(ids)))
+    outcome_noise, length_noise = environment._game_noise(num_games)
+    return Trace({
+        "skill": environment._skill,
+        "max_games": environment._max_games,
+        "max_time_queue": environment._max_time_queue,
+        # the environment has given the initial breaks counting from round 1
+        "initial_breaks": environment._wake_round - 1,
+        "breaks": breaks.reshape(num_players, games_per_player),
+        "outcome_noise": outcome_noise,
+        "length_noise": length_noise,
+    })
+
+
+class TraceEnvironment(AdvancedEnvironment):
+    """An AdvancedEnvironment that takes its randomness from a Trace instead of numpy.random."""
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+        self._num_games = 0
+        self._populate(trace.skill.astype(int), trace.max_games.astype(int), trace.max_time_queue.astype(int),
+                       trace.initial_breaks.astype(int))
+
+    @staticmethod
+    def from_file(path: str) -> 'TraceEnvironment':
+        return TraceEnvironment(Trace.load(path))
+
+    def _breaks_after_game(self, ids: numpy.ndarray) -> numpy.ndarray:
+        breaks = self.trace.breaks
+        return breaks[ids, self._games_played[ids] % breaks.shape[1]].astype(int)
+
+    def _game_noise(self, n: int) -> (numpy.ndarray, numpy.ndarray):
+        games = (self._num_games + numpy.arange(n)) % len(self.trace.outcome_noise)
+        self._num_games += n
+        return self.trace.outcome_noise[games].astype(float), self.trace.length_noise[games].astype(float)
@@ -1,4 +1,3 @@
-from core.demo import Demo
 from core.engine import Engine
 from core.matchmakers import fair_matchmaker, advanced_matchmaker2
 from core.environments import AdvancedEnvironment, SimpleEnvironment
@@ -15,6 +14,7 @@ def get_statistics():
 
 
 def run_demo():
+    from core.demo import Demo
     demo = Demo(wait_ms=100, bar_height=10, bg_color=(30, 30, 80))
     mm = advanced_matchmaker2
     env = SimpleEnvironment()
@@ -27,12 +27,12 @@ def test_mmr_engine():
     mmr_engine = BaseMmrEngine()
     env = AdvancedEnvironment(100, 20)
     engine = Engine(mm, mmr_engine, env)
-    for i in range(60*60*5):
-        engine.one_round()
-        if i % (60 * 10) == 0:
-            print(int(i / (60*10)))
+    for i in range(30):
+        print(i)
+        engine.run(60 * 10, event_driven=True)
     for name in engine.players:
         p = engine.players[name]
         print(name + " - mmr (" + str(p.mmr) + "), skill (" + str(env.get_player_skill(name)) + ")")
 
-run_demo()
+if __name__ == "__main__":
+    run_demo()
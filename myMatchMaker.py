@@ -1,3 +1,4 @@
+from itertools import islice
 from typing import List
 
 from core.common import MatchMaker, Queuer
@@ -7,4 +8,5 @@ class MyMatchMaker(MatchMaker):
     def find_lobbies(self, queue: List[Queuer], found_lobby_callback) -> None:
         if len(queue) < 10:
             return []
-        found_lobby_callback(queue[:5], queue[5:10])
+        head = list(islice(queue, 10))
+        found_lobby_callback(head[:5], head[5:])
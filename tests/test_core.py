@@ -0,0 +1,102 @@
+import random
+from itertools import combinations
+
+import pytest
+
+from core.common import Clock, Player, Queue, Queuer, player_mmr
+from core.matchmakers import TEAM_SIZE, SortedWindows, WaitDependentMmrDiff, max_mmr_diff, \
+    max_mmr_diff_or_long_wait, _best_windows, _filtered_find_by_sorted_mmr
+from core.mmr_index import MmrIndex
+
+
+def _check_against_oracle(index: MmrIndex, seq_of: dict):
+    oracle = sorted(seq_of, key=lambda p: (p.mmr, seq_of[p]))
+    assert len(index) == len(oracle)
+    assert list(index) == oracle
+    assert index.keys() == [(p.mmr, seq_of[p]) for p in oracle]
+    for rank, p in enumerate(oracle):
+        assert index.rank(p) == rank
+        assert index[rank] is p
+    for _ in range(5):
+        low = random.randint(900, 1100)
+        high = low + random.randint(0, 100)
+        assert index.between(low, high) == [p for p in oracle if low <= p.mmr <= high]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_mmr_index_matches_sorted_list(seed):
+    random.seed(seed)
+    # small buckets, so that they are split and emptied along the way
+    index = MmrIndex(player_mmr, load=4)
+    seq_of = dict()
+    num_added = 0
+    for step in range(300):
+        op = random.random()
+        if op < 0.5 or len(seq_of) < 10:
+            p = Player(str(num_added), random.randint(950, 1050), num_added)
+            index.add(p)
+            seq_of[p] = num_added
+            num_added += 1
+        elif op < 0.65:
+            p = random.choice(list(seq_of))
+            index.remove(p)
+            del seq_of[p]
+        elif op < 0.8:
+            removed = random.sample(list(seq_of), random.randint(1, 8))
+            index.remove_many(removed)
+            for p in removed:
+                del seq_of[p]
+        else:
+            p = random.choice(list(seq_of))
+            p.mmr = random.randint(950, 1050)
+            index.update(p)
+        if step % 10 == 0:
+            _check_against_oracle(index, seq_of)
+    _check_against_oracle(index, seq_of)
+
+
+def _brute_force_best_total(values, lobby_size):
+    best = 0.0
+    starts = [i for i, v in enumerate(values) if v > 0]
+    for n in range(1, len(starts) + 1):
+        for chosen in combinations(starts, n):
+            if all(b - a >= lobby_size for a, b in zip(chosen, chosen[1:])):
+                best = max(best, sum(values[i] for i in chosen))
+    return best
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_best_windows_is_optimal(seed):
+    random.seed(seed)
+    lobby_size = random.randint(1, 4)
+    values = [random.choice([float("-inf"), random.uniform(-5, 10)])
+              for _ in range(random.randint(0, 14))]
+    starts = _best_windows(values, lobby_size)
+    assert all(b - a >= lobby_size for a, b in zip(starts, starts[1:]))
+    assert all(values[i] > 0 for i in starts)
+    assert sum(values[i] for i in starts) == pytest.approx(_brute_force_best_total(values, lobby_size))
+
+
+@pytest.mark.parametrize("lobby_filter", [max_mmr_diff(150), max_mmr_diff_or_long_wait(150, 40),
+                                          WaitDependentMmrDiff()])
+def test_vectorized_find_matches_random_tries(lobby_filter):
+    random.seed(7)
+    clock = Clock()
+    clock.round = 100
+    queue = Queue()
+    for i in range(300):
+        queuer = Queuer(Player(str(i), random.randint(500, 3500), i), clock)
+        queuer.enqueued_at = random.randint(0, 100)
+        queue.append(queuer)
+    windows = SortedWindows()
+    for attempt in range(40):
+        random.seed(attempt)
+        expected = _filtered_find_by_sorted_mmr(queue, 20, lobby_filter)
+        random.seed(attempt)
+        found = _filtered_find_by_sorted_mmr(queue, 20, lobby_filter, windows)
+        if expected is None:
+            assert found is None
+            continue
+        assert [q.player.id for team in found for q in team] == [q.player.id for team in expected for q in team]
+        queue.remove_many(found[0] + found[1])
+    assert len(queue) <= 300 - TEAM_SIZE * 2